@@ -0,0 +1,43 @@
+from flask_jwt_extended import current_user
+from sqlalchemy import true
+from init import db
+import identity
+from models.appointment import Appointment
+from models.patient import Patient
+from models.customer import Customer
+
+# The conditions in SQL which are true for the records the current user can access, i.e.
+# an administrator can access every record,
+# a customer can access their own profile, patients and the appointments of their patients,
+# and a veterinarian can access the customers and patients they have appointments with, and their own appointments.
+# Each condition can be selected as a column to authorize one record in the query which fetches it, or used as a filter to restrict a list.
+
+
+# the condition on the customers table
+def customer_access():
+    if identity.is_admin():
+        return true()
+    elif identity.is_customer():
+        return Customer.id == current_user.id
+    customer_ids = db.select(Patient.customer_id).join(Appointment, Appointment.patient_id==Patient.id).filter(Appointment.veterinarian_id==current_user.id)
+    return Customer.id.in_(customer_ids)
+
+
+# the condition on the patients table
+def patient_access():
+    if identity.is_admin():
+        return true()
+    elif identity.is_customer():
+        return Patient.customer_id == current_user.id
+    patient_ids = db.select(Appointment.patient_id).filter(Appointment.veterinarian_id==current_user.id)
+    return Patient.id.in_(patient_ids)
+
+
+# the condition on the appointments table
+def appointment_access():
+    if identity.is_admin():
+        return true()
+    elif identity.is_customer():
+        patient_ids = db.select(Patient.id).filter(Patient.customer_id==current_user.id)
+        return Appointment.patient_id.in_(patient_ids)
+    return Appointment.veterinarian_id == current_user.id
@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from sqlalchemy.orm import attributes
+from sqlalchemy.dialects.postgresql import insert
+from init import db
+from routing import RoutingSession
+from models.appointment import Appointment
+from models.patient import Patient
+from models.analytics import WeeklyVeterinarianBookings, WeeklySpeciesBookings, AnalyticsDirtyWeek
+
+
+# get the week of the date, i.e. the date of its Monday as date_trunc('week', date) gives in PostgreSQL
+# the date may be a date or a string given in the request
+def week_of(value):
+    if isinstance(value, str):
+        value = datetime.strptime(value, '%Y-%m-%d').date()
+    return value - timedelta(days=value.weekday())
+
+
+# the week of a date column in SQL
+def week_column(column):
+    return db.cast(db.func.date_trunc('week', column), db.Date)
+
+
+# merge the weeks into the ranges of consecutive weeks, as (first day, last day)
+# filtering the appointments by date ranges rather than by week_column keeps the filter usable by indexes
+def week_ranges(weeks):
+    ranges = []
+    for week in sorted(weeks):
+        if ranges and ranges[-1][1] + timedelta(days=1) == week:
+            ranges[-1][1] = week + timedelta(days=6)
+        else:
+            ranges.append([week, week + timedelta(days=6)])
+    return ranges
+
+
+# mark the weeks of the dates as dirty through the connection, i.e. in the transaction which changes their appointments
+# the weeks are inserted in order, so that concurrent transactions lock the rows in the same order
+def mark_weeks(connection, dates):
+    weeks = sorted({week_of(value) for value in dates})
+    if weeks:
+        connection.execute(insert(AnalyticsDirtyWeek).values([{'week': week} for week in weeks]).on_conflict_do_nothing())
+
+
+# mark the weeks of all appointments of the patients as dirty, e.g. when their species has changed
+def mark_patient_weeks(connection, patient_ids):
+    weeks = db.select(week_column(Appointment.date)).filter(Appointment.patient_id.in_(patient_ids)).distinct()
+    connection.execute(insert(AnalyticsDirtyWeek).from_select(['week'], weeks).on_conflict_do_nothing())
+
+
+# mark the weeks of the appointments booked, moved or deleted by the flush, and of the patients whose species has changed
+# the appointments inserted without the ORM (i.e. the batch booking and the import) are marked where they are inserted
+@event.listens_for(RoutingSession, 'after_flush')
+def mark_changed_weeks(session, flush_context):
+    dates = set()
+    patient_ids = set()
+    for record in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(record, Appointment):
+            dates.update(value for value in attributes.get_history(record, 'date').sum() if value is not None)
+        elif isinstance(record, Patient) and record in session.dirty and attributes.get_history(record, 'species').has_changes():
+            patient_ids.add(record.id)
+    if dates:
+        mark_weeks(session.connection(), dates)
+    if patient_ids:
+        mark_patient_weeks(session.connection(), patient_ids)
+
+
+# recompute the summary rows of the dirty weeks, and return the weeks recomputed
+# with all_weeks, every week is recomputed, e.g. to fill the summary tables of an existing database
+# the dirty weeks are claimed (i.e. unmarked) in a short transaction of their own, so the bookings which mark them again meanwhile
+# are not blocked on their rows until the recompute commits, and a change committed meanwhile is recomputed by the next refresh
+# if the recompute fails, the claimed weeks are marked again
+def refresh(all_weeks=False):
+    if all_weeks:
+        weeks = db.select(week_column(Appointment.date)).distinct()
+        db.session.execute(insert(AnalyticsDirtyWeek).from_select(['week'], weeks).on_conflict_do_nothing())
+    dirty = AnalyticsDirtyWeek.__table__
+    weeks = db.session.scalars(dirty.delete().returning(dirty.c.week)).all()
+    db.session.commit()
+    if not weeks and not all_weeks:
+        return []
+    try:
+        if all_weeks:
+            db.session.execute(db.delete(WeeklyVeterinarianBookings))
+            db.session.execute(db.delete(WeeklySpeciesBookings))
+        else:
+            db.session.execute(db.delete(WeeklyVeterinarianBookings).filter(WeeklyVeterinarianBookings.week.in_(weeks)).execution_options(synchronize_session=False))
+            db.session.execute(db.delete(WeeklySpeciesBookings).filter(WeeklySpeciesBookings.week.in_(weeks)).execution_options(synchronize_session=False))
+        if weeks:
+            in_weeks = db.or_(*[Appointment.date.between(first, last) for first, last in week_ranges(weeks)])
+            week = week_column(Appointment.date)
+            veterinarian_bookings = db.select(week, Appointment.veterinarian_id, db.func.count()).filter(in_weeks).group_by(week, Appointment.veterinarian_id)
+            db.session.execute(insert(WeeklyVeterinarianBookings).from_select(['week', 'veterinarian_id', 'bookings'], veterinarian_bookings))
+            species_bookings = db.select(week, Patient.species, db.func.count()).join(Patient, Patient.id==Appointment.patient_id).filter(in_weeks).group_by(week, Patient.species)
+            db.session.execute(insert(WeeklySpeciesBookings).from_select(['week', 'species', 'bookings'], species_bookings))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        mark_weeks(db.session.connection(), weeks)
+        db.session.commit()
+        raise
+    return sorted(weeks)
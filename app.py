@@ -1,14 +1,31 @@
 from flask import Flask
 import os
-from init import db, ma, bcrypt, jwt, auto
+import gb
+from marshmallow import fields
+from sqlalchemy.orm import configure_mappers
+from init import db, ma, hasher, jwt
+from revocation import revocation
+from routing import router
+from instrumentation import instrumentation
 from controllers.cli_controller import db_commands
 from controllers.customers_controller import customers_bp
 from controllers.veterinarians_controller import veterinarians_bp
 from controllers.patients_controller import patients_bp
 from controllers.appointments_controller import appointments_bp
+from controllers.analytics_controller import analytics_bp
+from controllers.docs_controller import docs_bp, build_documents
+from controllers.metrics_controller import metrics_bp
+from models.customer import CustomerSchema
+from models.veterinarian import VeterinarianSchema
+from models.patient import PatientSchema
+from models.appointment import AppointmentSchema
+from models.slot_hold import SlotHoldSchema
 from sqlalchemy.exc import NoResultFound, DataError
 from sqlalchemy.exc import IntegrityError
 
+# the schemas built by warm_up, which are then reused through gb.schema
+WARM_SCHEMAS = [CustomerSchema, VeterinarianSchema, PatientSchema, AppointmentSchema, SlotHoldSchema]
+
 
 def create_app():
     app = Flask(__name__)
@@ -29,6 +46,10 @@ def create_app():
     def unauthorized_error(err):
         return {'error': str(err)}, 401
 
+    @app.errorhandler(503)
+    def service_unavailable(err):
+        return {'error': str(err)}, 503
+
     @app.errorhandler(ValueError)
     def value_error(err):
         return {'error': str(err)}, 403
@@ -37,19 +58,25 @@ def create_app():
     def type_error(err):
         return {'error': str(err)}, 403
 
+    # the violation and the constraint are read from the error of psycopg2, or else from the message of the error
     @app.errorhandler(IntegrityError)
     def integrity_error(err):
-        if 'UniqueViolation' in err.args[0]:
-            if 'appointment' in err.args[0]:
+        if getattr(err.orig, 'diag', None) and err.orig.diag.constraint_name:
+            violation = type(err.orig).__name__
+            constraint = err.orig.diag.constraint_name
+        else:
+            violation = constraint = err.args[0]
+        if 'UniqueViolation' in violation:
+            if 'appointment' in constraint:
                 return {'error': 'Appointment is not available for the required date and time'}, 409
-            elif 'email' in err.args[0]:
+            elif 'email' in constraint:
                 return {'error': 'Email exists already'}, 409
-            elif 'patient' in err.args[0]:
+            elif 'patient' in constraint:
                 return {'error': 'Patient exists already'}, 409
-        elif 'ForeignKeyViolation' in err.args[0]:
-            if 'patient' in err.args[0]:
+        elif 'ForeignKeyViolation' in violation:
+            if 'patient' in constraint:
                 return {'error': 'patient not exists'}, 404
-            elif 'veterinarian' in err.args[0]:
+            elif 'veterinarian' in constraint:
                 return {'error': 'veterinarian not exists'}, 404
 
     @app.errorhandler(NoResultFound)
@@ -79,22 +106,87 @@ def create_app():
         return {'error': f'{err.args[0]} is required'}, 400
 
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
+    # the options of the connection pools, set from the environment variables which are given
+    engine_options = {'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ['1', 'true', 'yes']}
+    for key, variable in [('pool_size', 'DB_POOL_SIZE'), ('max_overflow', 'DB_MAX_OVERFLOW'), ('pool_recycle', 'DB_POOL_RECYCLE'), ('pool_timeout', 'DB_POOL_TIMEOUT')]:
+        if os.environ.get(variable):
+            engine_options[key] = int(os.environ[variable])
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
+    # the read replica which serves the read requests, if any
+    if os.environ.get('REPLICA_DATABASE_URL'):
+        app.config['SQLALCHEMY_BINDS'] = {'replica': {'url': os.environ['REPLICA_DATABASE_URL'], **engine_options}}
+    app.config['REPLICA_STICKY_SECONDS'] = int(os.environ.get('REPLICA_STICKY_SECONDS', 5))
     app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY')
+    app.config['JWT_BLOCKLIST_SYNC_SECONDS'] = int(os.environ.get('JWT_BLOCKLIST_SYNC_SECONDS', 5))
+    app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    app.config['BCRYPT_POOL_SIZE'] = int(os.environ.get('BCRYPT_POOL_SIZE', os.cpu_count() or 1))
+    app.config['BCRYPT_QUEUE_LIMIT'] = int(os.environ.get('BCRYPT_QUEUE_LIMIT', 4 * (os.cpu_count() or 1)))
+    app.config['CLINIC_OPENING_TIME'] = os.environ.get('CLINIC_OPENING_TIME', '09:00')
+    app.config['CLINIC_CLOSING_TIME'] = os.environ.get('CLINIC_CLOSING_TIME', '17:00')
+    app.config['AVAILABILITY_MAX_DAYS'] = int(os.environ.get('AVAILABILITY_MAX_DAYS', 31))
+    app.config['PAGE_SIZE'] = int(os.environ.get('PAGE_SIZE', 50))
+    app.config['MAX_PAGE_SIZE'] = int(os.environ.get('MAX_PAGE_SIZE', 500))
+    app.config['BOOKING_BATCH_LIMIT'] = int(os.environ.get('BOOKING_BATCH_LIMIT', 500))
+    app.config['EXPORT_BATCH_SIZE'] = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+    # kept short, as a change clears the public cache of the process which makes it only (see controllers/veterinarians_controller.py)
+    app.config['PUBLIC_CACHE_SECONDS'] = int(os.environ.get('PUBLIC_CACHE_SECONDS', 5))
+    app.config['SCHEDULE_CACHE_SECONDS'] = int(os.environ.get('SCHEDULE_CACHE_SECONDS', 60))
+    app.config['HOLD_SECONDS'] = int(os.environ.get('HOLD_SECONDS', 120))
+    app.config['REMINDER_SINK'] = os.environ.get('REMINDER_SINK', 'file')
+    app.config['REMINDER_FILE'] = os.environ.get('REMINDER_FILE', 'reminders.ndjson')
+    app.config['REMINDER_SMTP_HOST'] = os.environ.get('REMINDER_SMTP_HOST', 'localhost')
+    app.config['REMINDER_SMTP_PORT'] = int(os.environ.get('REMINDER_SMTP_PORT', 1025))
+    app.config['REMINDER_SENDER'] = os.environ.get('REMINDER_SENDER', 'reminders@vetclinic.com')
+    app.config['REMINDER_CONCURRENCY'] = int(os.environ.get('REMINDER_CONCURRENCY', 10))
+    app.config['REMINDER_RETRIES'] = int(os.environ.get('REMINDER_RETRIES', 3))
+    app.config['REMINDER_BACKOFF_SECONDS'] = float(os.environ.get('REMINDER_BACKOFF_SECONDS', 1))
+    app.config['INSTRUMENTATION_ENABLED'] = os.environ.get('INSTRUMENTATION_ENABLED', '').lower() in ['1', 'true', 'yes']
+    # the static bearer token of the scraper of /metrics, which is not served without it
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
 
     db.init_app(app)
     ma.init_app(app)
-    bcrypt.init_app(app)
+    hasher.init_app(app)
     jwt.init_app(app)
-    auto.init_app(app)
+    revocation.init_app(app)
+    router.init_app(app)
+    instrumentation.init_app(app)
 
     app.register_blueprint(db_commands)
     app.register_blueprint(customers_bp)    
     app.register_blueprint(veterinarians_bp)    
     app.register_blueprint(patients_bp)    
     app.register_blueprint(appointments_bp)    
-
-    @app.route('/documentation')
-    def documentation():
-        return auto.html()
+    app.register_blueprint(analytics_bp)
+    app.register_blueprint(docs_bp)
+    app.register_blueprint(metrics_bp)
 
     return app
+
+
+# resolve the nested schemas of the schema, which marshmallow otherwise builds on their first dump
+def warm_schema(schema):
+    for field in schema.fields.values():
+        field = getattr(field, 'inner', field)
+        if isinstance(field, fields.Nested):
+            warm_schema(field.schema)
+
+
+# configure the mappers, compile the URL rules, build the schemas and the documentation of the app, without connecting to the database
+# run in the master process before the workers are forked (see wsgi.py), so that they share this work rather than each repeating it on its first requests
+def warm_up(app):
+    with app.app_context():
+        configure_mappers()
+        app.url_map.update()
+        for schema_class in WARM_SCHEMAS:
+            warm_schema(gb.schema(schema_class))
+            warm_schema(gb.schema(schema_class, many=True))
+    build_documents(app)
+
+
+# drop the connections inherited from the master in a forked worker, so that no connection is shared between processes
+# close=False leaves the connections open for the master, and the worker opens its own on its first query
+def dispose_engines(app):
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
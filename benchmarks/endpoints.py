@@ -0,0 +1,209 @@
+'''Endpoint latency benchmark.
+
+Builds the app with create_app() against a local PostgreSQL database, seeds it with synthetic data,
+then measures the latency percentiles, throughput and SQL statement count of every GET route of the
+blueprints (and the logins) under concurrent clients. The results are written to a JSON file so that
+runs can be compared between commits, e.g.
+
+    python -m benchmarks.endpoints --database-url postgresql://localhost/vet_bench --output bench.json
+
+The statement counts of the scenarios in QUERY_BUDGETS are pinned: if one of them needs more statements
+than its budget (e.g. a relationship which is lazy loaded per row again), the run exits with status 1.
+
+The database is dropped and recreated, so never point it at a database holding real data.
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PASSWORD = 'Benchmark1!'
+BLUEPRINTS = ['customers', 'veterinarians', 'patients', 'appointments']
+# the most SQL statements each scenario may take, including the lookup of the user of the token
+# the periodic sync of the revoked tokens is not counted: the blocklist is loaded before the scenarios and not synced again during the run
+QUERY_BUDGETS = {
+    'GET /customers/my_dashboard/ (customer)': 3,
+    'GET /customers/my_profile/ (customer)': 1,
+    'GET /patients/my_patients/ (customer)': 3,
+    'GET /appointments/my_appointments/ (customer)': 2,
+    'GET /appointments/my_appointments/ (veterinarian)': 2,
+    # the lists and the records served with the loading plans of their relationships
+    'GET /customers/ (admin)': 4,
+    'GET /customers/1/ (admin)': 4,
+    'GET /patients/ (admin)': 3,
+    'GET /patients/1/ (admin)': 3,
+    'GET /appointments/ (admin)': 2,
+    'GET /appointments/1/ (admin)': 2,
+    'GET /veterinarians/ (admin)': 3,
+    'GET /veterinarians/2/ (admin)': 3
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure the latency of the API endpoints against a local PostgreSQL database.')
+    parser.add_argument('--database-url', default=os.environ.get('BENCHMARK_DATABASE_URL'), help='PostgreSQL database which is dropped and seeded (or BENCHMARK_DATABASE_URL).')
+    parser.add_argument('--customers', type=int, default=200, help='Number of customers.')
+    parser.add_argument('--patients', type=int, default=2, help='Number of patients per customer.')
+    parser.add_argument('--veterinarians', type=int, default=10, help='Number of veterinarians.')
+    parser.add_argument('--appointments', type=int, default=500, help='Number of appointments per veterinarian.')
+    parser.add_argument('--clients', type=int, default=8, help='Number of concurrent clients.')
+    parser.add_argument('--requests', type=int, default=200, help='Number of requests per route.')
+    parser.add_argument('--output', default='bench_output.json', help='JSON file the results are written to.')
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error('--database-url or BENCHMARK_DATABASE_URL is required')
+    if args.customers * args.patients < args.veterinarians:
+        parser.error('there must be at least as many patients as veterinarians')
+    return args
+
+
+# drop and create the tables, then insert the synthetic data with executemany
+def seed(db, args):
+    from init import hasher
+    from models.customer import Customer
+    from models.veterinarian import Veterinarian
+    from models.patient import Patient
+    from models.appointment import Appointment
+
+    db.drop_all()
+    db.create_all()
+    password = hasher.hash(PASSWORD)
+    db.session.execute(db.insert(Veterinarian), [
+        {'first_name': f'Vet{i}', 'last_name': 'Bench', 'email': f'vet{i}@vet.com', 'password': password, 'sex': 'Female', 'is_admin': i == 1}
+        for i in range(1, args.veterinarians + 1)
+    ])
+    db.session.execute(db.insert(Customer), [
+        {'first_name': f'Customer{i}', 'last_name': 'Bench', 'email': f'customer{i}@test.com', 'password': password, 'contact_number': '0400000000'}
+        for i in range(1, args.customers + 1)
+    ])
+    db.session.execute(db.insert(Patient), [
+        {'name': f'Pet{j}', 'age': 1 + j, 'weight': 5.5, 'sex': 'Male', 'species': ['dog', 'cat', 'bird', 'fish', 'rabbit'][(i + j) % 5], 'customer_id': i}
+        for i in range(1, args.customers + 1) for j in range(args.patients)
+    ])
+    # spread the appointments of each veterinarian over the 32 slots of each day from 30 days ago onwards,
+    # and give the veterinarians different patients in the same slot
+    total_patients = args.customers * args.patients
+    first_date = date.today() - timedelta(days=30)
+    rows = []
+    for k in range(args.appointments):
+        slot = datetime.combine(first_date + timedelta(days=k // 32), datetime.min.time()) + timedelta(hours=9, minutes=15 * (k % 32))
+        for v in range(args.veterinarians):
+            rows.append({'date': slot.date(), 'time': slot.time(), 'veterinarian_id': v + 1, 'patient_id': (k * args.veterinarians + v) % total_patients + 1})
+    for start in range(0, len(rows), 10000):
+        db.session.execute(db.insert(Appointment), rows[start:start + 10000])
+    db.session.commit()
+
+
+# build the requests to measure: every GET route of the blueprints as each role, and the logins
+def scenarios(app):
+    from flask_jwt_extended import create_access_token
+    with app.app_context():
+        tokens = {
+            'admin': create_access_token(identity='1', additional_claims={'role': 'veterinarian'}),
+            'veterinarian': create_access_token(identity='2', additional_claims={'role': 'veterinarian'}),
+            'customer': create_access_token(identity='1', additional_claims={'role': 'customer'})
+        }
+    arguments = {'customer_id': 1, 'patient_id': 1, 'appointment_id': 1, 'veterinarian_id': 2}
+    result = []
+    for rule in sorted(app.url_map.iter_rules(), key=lambda rule: rule.rule):
+        if 'GET' not in rule.methods or rule.endpoint.split('.')[0] not in BLUEPRINTS:
+            continue
+        url = rule.rule
+        for name, value in arguments.items():
+            url = url.replace(f'<int:{name}>', str(value))
+        roles = ['admin', 'veterinarian', 'customer'] if 'my_' in url else ['admin']
+        for role in roles:
+            result.append({'name': f'GET {url} ({role})', 'method': 'GET', 'url': url, 'headers': {'Authorization': f'Bearer {tokens[role]}'}})
+    result.append({'name': 'POST /customers/login/', 'method': 'POST', 'url': '/customers/login/', 'json': {'email': 'customer1@test.com', 'password': PASSWORD}})
+    result.append({'name': 'POST /veterinarians/login/', 'method': 'POST', 'url': '/veterinarians/login/', 'json': {'email': 'vet2@vet.com', 'password': PASSWORD}})
+    return result
+
+
+def send(client, scenario):
+    started = time.perf_counter()
+    response = client.open(scenario['url'], method=scenario['method'], headers=scenario.get('headers'), json=scenario.get('json'))
+    response.get_data()
+    return time.perf_counter() - started, response.status_code
+
+
+# measure one scenario: the statement count of one request, checked against its budget, then the latencies of all requests sent by the concurrent clients
+def measure(app, scenario, args):
+    from query_counter import assert_max_queries
+    client = app.test_client()
+    budget = QUERY_BUDGETS.get(scenario['name'])
+    over_budget = False
+    try:
+        with assert_max_queries(app, budget if budget is not None else float('inf')) as statements:
+            _, status = send(client, scenario)
+    except AssertionError as err:
+        print(err)
+        over_budget = True
+
+    def run_client(count):
+        client = app.test_client()
+        return [send(client, scenario)[0] for _ in range(count)]
+
+    counts = [args.requests // args.clients + (1 if i < args.requests % args.clients else 0) for i in range(args.clients)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.clients) as executor:
+        latencies = [latency for result in executor.map(run_client, counts) for latency in result]
+    elapsed = time.perf_counter() - started
+    percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        'status': status,
+        'statements': len(statements),
+        'budget': budget,
+        'over_budget': over_budget,
+        'requests': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'p50_ms': percentiles[49] * 1000,
+        'p95_ms': percentiles[94] * 1000,
+        'p99_ms': percentiles[98] * 1000
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = parse_args()
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ.setdefault('JWT_SECRET_KEY', 'benchmark')
+    os.environ['JWT_BLOCKLIST_SYNC_SECONDS'] = str(24 * 60 * 60)
+    from app import create_app
+    from init import db
+    from revocation import revocation
+    app = create_app()
+    with app.app_context():
+        seed(db, args)
+        revocation.sync()
+    results = {}
+    for scenario in scenarios(app):
+        results[scenario['name']] = measure(app, scenario, args)
+        result = results[scenario['name']]
+        print(f"{scenario['name']:<70} {result['status']} p50 {result['p50_ms']:8.1f}ms p95 {result['p95_ms']:8.1f}ms p99 {result['p99_ms']:8.1f}ms {result['throughput']:8.1f} req/s {result['statements']:3} SQL")
+    parameters = {key: value for key, value in vars(args).items() if key not in ['database_url', 'output']}
+    with open(args.output, 'w') as f:
+        json.dump({'commit': git_commit(), 'timestamp': datetime.now().isoformat(), 'parameters': parameters, 'results': results}, f, indent=2)
+    print(f'Results written to {args.output}')
+    over_budget = [name for name, result in results.items() if result['over_budget']]
+    for name in over_budget:
+        print(f"{name} took {results[name]['statements']} SQL statements, more than its budget of {QUERY_BUDGETS[name]}")
+    if over_budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+'''Booking contention benchmark.
+
+Builds the app with create_app() against a local PostgreSQL database, then lets a growing number of concurrent
+clients compete for the same appointment slot, either booking it directly or holding it and confirming the hold.
+For each run it reports how many bookings succeeded, how many were turned away with 409, and how many database
+statements failed (each of which aborts its transaction, e.g. on the unique constraints). Both ways resolve the
+contention with the advisory locks and the holds before the insert, so the failed-statement rate must stay flat
+as the number of clients grows: the run exits with status 1 if the rate of any run exceeds --max-failed-rate
+(0 by default) or a request answers anything but 201 or 409. The results are written to a JSON file, e.g.
+
+    python -m benchmarks.holds --database-url postgresql://localhost/vet_bench --output holds.json
+
+The database is dropped and recreated, so never point it at a database holding real data.
+'''
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.endpoints import git_commit
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure the failed transactions of concurrent bookings of one slot against a local PostgreSQL database.')
+    parser.add_argument('--database-url', default=os.environ.get('BENCHMARK_DATABASE_URL'), help='PostgreSQL database which is dropped and seeded (or BENCHMARK_DATABASE_URL).')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32], help='Numbers of concurrent clients to run.')
+    parser.add_argument('--rounds', type=int, default=20, help='Number of slots competed for by each number of clients.')
+    parser.add_argument('--max-failed-rate', type=float, default=0.0, help='Most failed statements per attempt allowed in each run.')
+    parser.add_argument('--output', default='holds_output.json', help='JSON file the results are written to.')
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error('--database-url or BENCHMARK_DATABASE_URL is required')
+    return args
+
+
+# drop and create the tables, then insert one veterinarian, and one customer with one patient for each client
+# so that the clients book as different users and compete for the holds of each other
+def seed(db, clients):
+    from init import hasher
+    from models.customer import Customer
+    from models.veterinarian import Veterinarian
+    from models.patient import Patient
+
+    db.drop_all()
+    db.create_all()
+    password = hasher.hash('Benchmark1!')
+    db.session.add(Veterinarian(first_name='Vet', last_name='Bench', email='vet@vet.com', password=password, sex='Female', is_admin=True))
+    db.session.execute(db.insert(Customer), [
+        {'first_name': 'Customer', 'last_name': f'Bench{i}', 'email': f'customer{i}@test.com', 'password': password, 'contact_number': f'04{i:08}'} for i in range(1, clients + 1)
+    ])
+    db.session.execute(db.insert(Patient), [
+        {'name': f'Pet{i}', 'age': 1, 'weight': 5.5, 'sex': 'Male', 'species': 'dog', 'customer_id': i} for i in range(1, clients + 1)
+    ])
+    db.session.commit()
+
+
+# book the slot for the patient directly
+def book(client, headers, booking):
+    return client.post('/appointments/book/', json=booking, headers=headers).status_code
+
+
+# hold the slot for the patient, then confirm the hold
+def hold_and_confirm(client, headers, booking):
+    response = client.post('/appointments/hold', json=booking, headers=headers)
+    if response.status_code != 201:
+        return response.status_code
+    return client.post(f"/appointments/hold/{response.json['id']}/confirm", headers=headers).status_code
+
+
+# let the clients compete for one slot per round with the given way of booking, and count the outcomes
+# client i books for patient i with the token of customer i
+def run(app, tokens, clients, rounds, attempt, failed_statements):
+    outcomes = {'booked': 0, 'conflict': 0, 'other': 0}
+    first_date = date.today() + timedelta(days=1)
+    barrier = threading.Barrier(clients)
+
+    def run_client(patient_id):
+        client = app.test_client()
+        headers = {'Authorization': f'Bearer {tokens[patient_id - 1]}'}
+        statuses = []
+        for k in range(rounds):
+            slot = datetime.combine(first_date + timedelta(days=k // 32), datetime.min.time()) + timedelta(hours=9, minutes=15 * (k % 32))
+            booking = {'date': slot.date().isoformat(), 'time': slot.strftime('%H:%M'), 'veterinarian_id': 1, 'patient_id': patient_id}
+            barrier.wait()
+            statuses.append(attempt(client, headers, booking))
+        return statuses
+
+    failed_before = failed_statements[0]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(clients) as executor:
+        for statuses in executor.map(run_client, range(1, clients + 1)):
+            for status in statuses:
+                outcomes['booked' if status == 201 else 'conflict' if status == 409 else 'other'] += 1
+    elapsed = time.perf_counter() - started
+    attempts = clients * rounds
+    failed = failed_statements[0] - failed_before
+    return {**outcomes, 'attempts': attempts, 'failed_statements': failed, 'failed_rate': failed / attempts, 'seconds': elapsed}
+
+
+def main():
+    args = parse_args()
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ.setdefault('JWT_SECRET_KEY', 'benchmark')
+    from flask_jwt_extended import create_access_token
+    from sqlalchemy import event
+    from app import create_app
+    from init import db
+    from models.appointment import Appointment
+    from models.slot_hold import SlotHold
+    app = create_app()
+    failed_statements = [0]
+    with app.app_context():
+        seed(db, max(args.clients))
+        tokens = [create_access_token(identity=str(i), additional_claims={'role': 'customer'}) for i in range(1, max(args.clients) + 1)]
+        # every database error aborts the transaction it happens in
+        event.listen(db.engine, 'handle_error', lambda context: failed_statements.__setitem__(0, failed_statements[0] + 1))
+    results = {}
+    for mode, attempt in [('book', book), ('hold', hold_and_confirm)]:
+        for clients in args.clients:
+            with app.app_context():
+                db.session.execute(db.delete(Appointment))
+                db.session.execute(db.delete(SlotHold))
+                db.session.commit()
+            name = f'{mode} x{clients}'
+            results[name] = result = run(app, tokens, clients, args.rounds, attempt, failed_statements)
+            print(f"{name:<12} {result['booked']:5} booked {result['conflict']:5} conflicts {result['other']:5} other {result['failed_statements']:5} failed statements ({result['failed_rate']:.1%} of attempts) in {result['seconds']:.1f}s")
+    parameters = {key: value for key, value in vars(args).items() if key not in ['database_url', 'output']}
+    with open(args.output, 'w') as f:
+        json.dump({'commit': git_commit(), 'timestamp': datetime.now().isoformat(), 'parameters': parameters, 'results': results}, f, indent=2)
+    print(f'Results written to {args.output}')
+    failures = []
+    for name, result in results.items():
+        if result['failed_rate'] > args.max_failed_rate:
+            failures.append(f"{name} had {result['failed_statements']} failed statements, more than {args.max_failed_rate:.1%} of its attempts")
+        if result['other']:
+            failures.append(f"{name} had {result['other']} requests answered with neither 201 nor 409")
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+'''Startup benchmark.
+
+Measures in fresh Python processes how long the app takes to import, to be created with create_app(), to be warmed
+up with warm_up() as in wsgi.py, and to answer its first request (GET /veterinarians/public/) both without and with the warm-up.
+Each measure is the median of several runs, and the results are appended to a JSON history file together with the
+commit, so that the cold start can be tracked over releases, e.g.
+
+    python -m benchmarks.startup --database-url postgresql://localhost/vet_bench --history startup_history.json
+
+The tables are created if they do not exist, and no data is changed.
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.endpoints import git_commit
+
+FIRST_REQUEST = '/veterinarians/public/'
+MEASURES = ['import_s', 'create_app_s', 'warm_up_s', 'first_request_cold_s', 'first_request_warm_s']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure the import time and the time to the first request of the app.')
+    parser.add_argument('--database-url', default=os.environ.get('BENCHMARK_DATABASE_URL'), help='PostgreSQL database the first request queries (or BENCHMARK_DATABASE_URL).')
+    parser.add_argument('--runs', type=int, default=5, help='Number of fresh processes measured for each mode.')
+    parser.add_argument('--history', default='startup_history.json', help='JSON file the results are appended to.')
+    parser.add_argument('--child', choices=['cold', 'warm'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if not args.database_url and not args.child:
+        parser.error('--database-url or BENCHMARK_DATABASE_URL is required')
+    return args
+
+
+# run in a fresh process: import and create the app, warm it up if asked, then send the first request, and print the durations as JSON
+def child(mode):
+    result = {}
+    started = time.perf_counter()
+    from app import create_app, warm_up
+    result['import_s'] = time.perf_counter() - started
+    started = time.perf_counter()
+    app = create_app()
+    result['create_app_s'] = time.perf_counter() - started
+    if mode == 'warm':
+        started = time.perf_counter()
+        warm_up(app)
+        result['warm_up_s'] = time.perf_counter() - started
+    started = time.perf_counter()
+    status = app.test_client().get(FIRST_REQUEST).status_code
+    result[f'first_request_{mode}_s'] = time.perf_counter() - started
+    result['status'] = status
+    print(json.dumps(result))
+
+
+# run the child in a fresh process and return its durations
+def run_child(mode, env):
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.startup', '--child', mode], cwd=ROOT, env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        child(args.child)
+        return
+    env = {**os.environ, 'DATABASE_URL': args.database_url}
+    env.setdefault('JWT_SECRET_KEY', 'benchmark')
+    os.environ.update(env)
+    from app import create_app
+    from init import db
+    with create_app().app_context():
+        db.create_all()
+    samples = {}
+    for mode in ['cold', 'warm']:
+        for _ in range(args.runs):
+            result = run_child(mode, env)
+            if result.pop('status') != 200:
+                sys.exit(f'{FIRST_REQUEST} did not answer 200 in the {mode} run')
+            for key, value in result.items():
+                samples.setdefault(key, []).append(value)
+    results = {key: statistics.median(samples[key]) for key in MEASURES}
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history) as f:
+            history = json.load(f)
+    previous = history[-1]['results'] if history else {}
+    for key in MEASURES:
+        change = f" ({results[key] - previous[key]:+.3f}s since {history[-1]['commit'][:8]})" if key in previous and history[-1]['commit'] else ''
+        print(f'{key:<22} {results[key]:.3f}s{change}')
+    parameters = {'runs': args.runs}
+    history.append({'commit': git_commit(), 'timestamp': datetime.now().isoformat(), 'parameters': parameters, 'results': results})
+    with open(args.history, 'w') as f:
+        json.dump(history, f, indent=2)
+    print(f'Results appended to {args.history}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+from flask import Blueprint
+import click
+import analytics
+import gb
+import identity
+from init import db
+from models.veterinarian import Veterinarian
+from models.analytics import WeeklyVeterinarianBookings, WeeklySpeciesBookings
+from flask_jwt_extended import jwt_required
+from datetime import datetime, date, timedelta
+
+
+analytics_bp = Blueprint('analytics', __name__, url_prefix='/analytics')
+
+
+# get the first and the last week from the query string arguments from and to, which default to the twelve weeks up to the current one
+def week_range():
+    this_week = analytics.week_of(datetime.today().date())
+    week_from = analytics.week_of(gb.date_argument('from', this_week - timedelta(weeks=11)))
+    week_to = analytics.week_of(gb.date_argument('to', this_week))
+    if week_to < week_from:
+        raise ValueError('Invalid date range.')
+    return week_from, week_to
+
+
+# get the number of appointment slots of one veterinarian in a week within the clinic hours, as the clinic is open every day
+def weekly_slots():
+    opening, closing = gb.clinic_hours()
+    minutes = (datetime.combine(date.today(), closing) - datetime.combine(date.today(), opening)).seconds // 60
+    return minutes // gb.SLOT_MINUTES * 7
+
+
+# read the utilization of each veterinarian per week
+@analytics_bp.route('/utilization')
+@jwt_required()
+def get_utilization():
+    '''Admin interface - Return the number of appointments of each veterinarian per week, with their capacity (i.e. the slots within the clinic hours of the week) and utilization (i.e. appointments divided by capacity). The query string arguments are from and to in the format of yyyy-mm-dd, and are both optional. Each date stands for its week starting on Monday, and the default range is the twelve weeks up to the current one. The figures are read from the summary tables as of the last `flask analytics refresh`.'''
+    if identity.is_admin():
+        week_from, week_to = week_range()
+        capacity = weekly_slots()
+        stmt = db.select(
+            WeeklyVeterinarianBookings.week, WeeklyVeterinarianBookings.veterinarian_id, WeeklyVeterinarianBookings.bookings,
+            Veterinarian.first_name, Veterinarian.last_name
+        ).join(Veterinarian, Veterinarian.id==WeeklyVeterinarianBookings.veterinarian_id).filter(
+            WeeklyVeterinarianBookings.week.between(week_from, week_to)
+        ).order_by(WeeklyVeterinarianBookings.week, WeeklyVeterinarianBookings.veterinarian_id)
+        utilization = [{
+            'week': row.week.isoformat(),
+            'veterinarian_id': row.veterinarian_id,
+            'first_name': row.first_name,
+            'last_name': row.last_name,
+            'bookings': row.bookings,
+            'capacity': capacity,
+            'utilization': round(row.bookings / capacity, 4)
+        } for row in db.session.execute(stmt)]
+        return {'from': week_from.isoformat(), 'to': week_to.isoformat(), 'utilization': utilization}
+    else:
+        return {'error': 'You are not an administrator.'}, 401
+
+
+# read the appointments of each species per week
+@analytics_bp.route('/species')
+@jwt_required()
+def get_species_bookings():
+    '''Admin interface - Return the number of appointments of the patients of each species per week. The query string arguments are from and to as for the utilization.'''
+    if identity.is_admin():
+        week_from, week_to = week_range()
+        stmt = db.select(WeeklySpeciesBookings).filter(WeeklySpeciesBookings.week.between(week_from, week_to)).order_by(WeeklySpeciesBookings.week, WeeklySpeciesBookings.species)
+        species = [{'week': row.week.isoformat(), 'species': row.species.name, 'bookings': row.bookings} for row in db.session.scalars(stmt)]
+        return {'from': week_from.isoformat(), 'to': week_to.isoformat(), 'species': species}
+    else:
+        return {'error': 'You are not an administrator.'}, 401
+
+
+# read the capacity of the clinic per week
+@analytics_bp.route('/capacity')
+@jwt_required()
+def get_capacity():
+    '''Admin interface - Return the capacity of the clinic per week, i.e. the slots of all current veterinarians within the clinic hours of the week, with the number of appointments and free slots and the utilization. Every week in the range is included, also those without appointments. The query string arguments are from and to as for the utilization.'''
+    if identity.is_admin():
+        week_from, week_to = week_range()
+        veterinarians = db.session.scalar(db.select(db.func.count(Veterinarian.id)))
+        capacity = weekly_slots() * veterinarians
+        stmt = db.select(WeeklyVeterinarianBookings.week, db.func.sum(WeeklyVeterinarianBookings.bookings)).filter(
+            WeeklyVeterinarianBookings.week.between(week_from, week_to)
+        ).group_by(WeeklyVeterinarianBookings.week)
+        bookings = dict(db.session.execute(stmt).all())
+        weeks = []
+        week = week_from
+        while week <= week_to:
+            booked = int(bookings.get(week, 0))
+            weeks.append({
+                'week': week.isoformat(),
+                'veterinarians': veterinarians,
+                'capacity': capacity,
+                'bookings': booked,
+                'free': max(capacity - booked, 0),
+                'utilization': round(booked / capacity, 4) if capacity else None
+            })
+            week += timedelta(weeks=1)
+        return {'from': week_from.isoformat(), 'to': week_to.isoformat(), 'capacity': weeks}
+    else:
+        return {'error': 'You are not an administrator.'}, 401
+
+
+# recompute the summary tables of the analytics for the weeks whose appointments have changed since the last refresh
+@analytics_bp.cli.command('refresh')
+@click.option('--all', 'all_weeks', is_flag=True, help='Recompute every week, e.g. to fill the summary tables of an existing database.')
+def refresh_analytics(all_weeks):
+    started = datetime.now()
+    weeks = analytics.refresh(all_weeks)
+    elapsed = (datetime.now() - started).total_seconds()
+    if weeks:
+        print(f'{len(weeks)} weeks refreshed from {weeks[0].isoformat()} to {weeks[-1].isoformat()} in {elapsed:.1f}s')
+    else:
+        print('No weeks to refresh')
@@ -1,33 +1,41 @@
-from flask import Blueprint, request
+from flask import Blueprint, request, current_app
+import click
+import reminders
+import analytics
 import gb
-from init import db, jwt, auto
+import identity
+import access
+from init import db
 from models.appointment import AppointmentSchema, Appointment
 from models.patient import Patient
-from models.customer import Customer
 from models.veterinarian import Veterinarian
-from flask_jwt_extended import jwt_required, get_jwt, current_user
-from datetime import datetime
+from models.customer import Customer
+from models.slot_hold import SlotHold, SlotHoldSchema
+from instrumentation import timed
+from cache import LRUCache
+from routing import RoutingSession, primary
+from flask_jwt_extended import jwt_required, current_user
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload, attributes
+from sqlalchemy.dialects.postgresql import insert
+from datetime import datetime, timedelta
 
 
 appointments_bp = Blueprint('appointments', __name__, url_prefix='/appointments')
 
+# the relationships serialized by AppointmentSchema, loaded together with the appointments to avoid one query per appointment
+# i.e. the patient with its customer, and the veterinarian
+appointment_loading_plan = [joinedload(Appointment.patient).joinedload(Patient.customer), joinedload(Appointment.veterinarian)]
+# the same for AppointmentSchema excluding the patient, which still needs patient.name
+appointment_without_patient_loading_plan = [joinedload(Appointment.patient), joinedload(Appointment.veterinarian)]
 
-# check if the person is authorized
-def is_appointment_authorized_person(appointment_id):
-    customer_id = gb.get_customer_id()
-    veterinarian_id = gb.get_veterinarian_id()
-    if customer_id:
-        # Through the relationships among the appointments, patients and customers tables, get one record from the appointments table using the given appointment_id and the customer_id obtained from the token
-        stmt = db.select(Appointment).filter_by(id=appointment_id).join(Patient, Patient.id==Appointment.patient_id).filter_by(customer_id=customer_id)
-        result = db.session.scalar(stmt)
-        if result:
-            return True
-    elif veterinarian_id:
-        # In the appointments table, get one record with the given appointment_id and the veterinarian_id obtained from the token
-        stmt = db.select(Appointment).filter_by(veterinarian_id=veterinarian_id, id=appointment_id)
-        result = db.session.scalar(stmt)
-        if result:
-            return True
+# the most bookings whose advisory locks are taken in one statement, i.e. two columns each
+LOCK_BATCH_SIZE = 200
+
+# the rendered day sheets of the clinic by date in the format of yyyy-mm-dd
+# a sheet is dropped when an appointment on its date is booked, moved or deleted in this process,
+# and the entries also expire after SCHEDULE_CACHE_SECONDS for the changes made by other processes
+schedule_cache = LRUCache(max_size=366)
 
 
 # get all appointments with one veterinarian
@@ -36,140 +44,299 @@ def filter_all_records(id):
     return db.session.scalars(stmt)
 
 
-@jwt.user_lookup_loader
-def user_lookup_callback(_jwt_header, jwt_data):
-    identity = jwt_data['sub']
-    if jwt_data['role'] == 'veterinarian':
-        return Veterinarian.query.filter_by(id=identity).one_or_none()
-    else:
-        return Customer.query.filter_by(id=identity).one_or_none()
-
-
 # read all appointments
 @appointments_bp.route('/')
-@auto.doc()
 @jwt_required()
 def get_all_appointments():
-    '''Admin interface - Return all appointments.'''
-    if gb.is_admin():
-        # get all records from the appointments table
-        appointments = gb.filter_all_records(Appointment)
-        return AppointmentSchema(many=True).dump(appointments)
+    '''Return one page of the appointments the current user can access, ordered by id, i.e. all appointments for an administrator, the appointments of the current veterinarian, or the appointments of the patients of the current customer. The query string arguments are limit and after for paging, and from, to, veterinarian_id, patient_id and customer_id for filtering, and are all optional. The format of the values are: yyyy-mm-dd for from and to, and integer for the others. The Link header contains the URL of the next page, if any.'''
+    # get one page of the records from the appointments table which the current user can access and match the filters
+    stmt = db.select(Appointment).filter(access.appointment_access()).options(*appointment_loading_plan)
+    date_from = gb.date_argument('from')
+    date_to = gb.date_argument('to')
+    veterinarian_id = gb.int_argument('veterinarian_id')
+    patient_id = gb.int_argument('patient_id')
+    customer_id = gb.int_argument('customer_id')
+    if date_from:
+        stmt = stmt.filter(Appointment.date >= date_from)
+    if date_to:
+        stmt = stmt.filter(Appointment.date <= date_to)
+    if veterinarian_id:
+        stmt = stmt.filter(Appointment.veterinarian_id == veterinarian_id)
+    if patient_id:
+        stmt = stmt.filter(Appointment.patient_id == patient_id)
+    if customer_id:
+        stmt = stmt.join(Patient, Patient.id==Appointment.patient_id).filter(Patient.customer_id == customer_id)
+    appointments, headers = gb.paginate(stmt, Appointment)
+    return gb.dump(AppointmentSchema, appointments, many=True), 200, headers
+
+
+# the columns of the appointments of the current user, with the patient and its customer for a veterinarian
+my_appointments_veterinarian_columns = [
+    Appointment.id, Appointment.date, Appointment.time, Appointment.patient_id,
+    Patient.name.label('patient_name'), Patient.age.label('patient_age'), Patient.weight.label('patient_weight'),
+    Patient.sex.label('patient_sex'), Patient.species.label('patient_species'), Patient.customer_id,
+    Customer.first_name.label('customer_first_name'), Customer.last_name.label('customer_last_name'),
+    Customer.email.label('customer_email'), Customer.contact_number.label('customer_contact_number')
+]
+# and with the veterinarian for a customer
+my_appointments_customer_columns = [
+    Appointment.id, Appointment.date, Appointment.time, Appointment.veterinarian_id, Appointment.patient_id,
+    Patient.name.label('patient_name'), Veterinarian.first_name.label('veterinarian_first_name'),
+    Veterinarian.last_name.label('veterinarian_last_name'), Veterinarian.email.label('veterinarian_email')
+]
+
+
+# get the statement selecting the appointments of the current user in date and time order, as rows of columns rather than models
+# for a veterinarian the composite index on (veterinarian_id, date, time) serves the query and any date range of it
+def my_appointments_stmt():
+    if identity.is_veterinarian():
+        return db.select(*my_appointments_veterinarian_columns).join(Patient, Patient.id==Appointment.patient_id).join(Customer, Customer.id==Patient.customer_id).filter(Appointment.veterinarian_id==current_user.id).order_by(Appointment.date, Appointment.time)
+    else:
+        return customer_appointments_stmt(current_user.id)
+
+
+# get the statement selecting the appointments of the customer in date and time order, as rows of my_appointments_customer_columns
+# the appointments are associated with the customer through the patients table
+def customer_appointments_stmt(customer_id):
+    return db.select(*my_appointments_customer_columns).join(Patient, Patient.id==Appointment.patient_id).join(Veterinarian, Veterinarian.id==Appointment.veterinarian_id).filter(Patient.customer_id==customer_id).order_by(Appointment.date, Appointment.time)
+
+
+# serialize one row of a veterinarian as AppointmentSchema(exclude=['veterinarian', 'veterinarian_id']) would
+def dump_veterinarian_appointment_row(row):
+    return {
+        'id': row.id,
+        'date': row.date.isoformat(),
+        'time': row.time.isoformat(),
+        'patient_id': row.patient_id,
+        'patient.name': row.patient_name,
+        'patient': {
+            'name': row.patient_name,
+            'age': row.patient_age,
+            'weight': row.patient_weight,
+            'sex': row.patient_sex.name,
+            'species': row.patient_species.name,
+            'customer_id': row.customer_id,
+            'customer': {
+                'first_name': row.customer_first_name,
+                'last_name': row.customer_last_name,
+                'email': row.customer_email,
+                'contact_number': row.customer_contact_number
+            }
+        }
+    }
+
+
+# serialize one row of a customer as AppointmentSchema(exclude=['patient']) would
+def dump_customer_appointment_row(row):
+    return {
+        'id': row.id,
+        'date': row.date.isoformat(),
+        'time': row.time.isoformat(),
+        'veterinarian_id': row.veterinarian_id,
+        'patient_id': row.patient_id,
+        'patient.name': row.patient_name,
+        'veterinarian': {
+            'first_name': row.veterinarian_first_name,
+            'last_name': row.veterinarian_last_name,
+            'email': row.veterinarian_email
+        }
+    }
+
+
+# serialize the rows of the appointments of the current user without the details of the current user
+def dump_my_appointments(rows):
+    dump_row = dump_veterinarian_appointment_row if identity.is_veterinarian() else dump_customer_appointment_row
+    with timed('serialize'):
+        return [dump_row(row) for row in rows]
+
+
+# serialize the appointments of the current user which match the given condition on the date, or return an error if there is none
+def dump_my_appointments_on(condition):
+    result = db.session.execute(my_appointments_stmt().filter(condition)).all()
+    if result:
+        return dump_my_appointments(result)
+    else:
+        return {'msg': 'No appointments found'}, 404
+
+
+# export all appointments
+@appointments_bp.route('/export')
+@jwt_required()
+def export_appointments():
+    '''Admin interface - Stream all appointments ordered by id as NDJSON or CSV. The query string arguments are format (ndjson or csv, ndjson by default), and from and to in the format of yyyy-mm-dd, and are all optional.'''
+    if identity.is_admin():
+        stmt = db.select(
+            Appointment.id, Appointment.date, Appointment.time, Appointment.veterinarian_id, Appointment.patient_id,
+            Patient.name.label('patient_name'), Patient.species, Patient.customer_id
+        ).join(Patient, Patient.id==Appointment.patient_id).order_by(Appointment.id)
+        date_from = gb.date_argument('from')
+        date_to = gb.date_argument('to')
+        if date_from:
+            stmt = stmt.filter(Appointment.date >= date_from)
+        if date_to:
+            stmt = stmt.filter(Appointment.date <= date_to)
+        return gb.export_response(stmt, 'appointments')
     else:
         return {'error': 'You are not an administrator.'}, 401
-        
+
 
 # read all appointments of the current user
 @appointments_bp.route('/my_appointments/')
-@auto.doc()
 @jwt_required()
 def get_my_appointments():
-    '''Return all appointments of the current user.'''
-    if get_jwt()['role'] == 'veterinarian':
-        return AppointmentSchema(many=True, exclude=['veterinarian', 'veterinarian_id']).dump(current_user.appointments)
-    else:
-        # get all records from the appointments table which is associated with the current customer id through the patients table
-        customer_id = current_user.id
-        stmt = db.select(Appointment).join(Patient, Patient.id==Appointment.patient_id).filter_by(customer_id=customer_id) 
-        result = db.session.scalars(stmt)
-        return AppointmentSchema(many=True, exclude=['patient']).dump(result)
+    '''Return all appointments of the current user in date and time order. The query string arguments are from and to in the format of yyyy-mm-dd, and are both optional. If given, only the appointments on or after from and on or before to are returned.'''
+    stmt = my_appointments_stmt()
+    date_from = gb.date_argument('from')
+    date_to = gb.date_argument('to')
+    if date_from:
+        stmt = stmt.filter(Appointment.date >= date_from)
+    if date_to:
+        stmt = stmt.filter(Appointment.date <= date_to)
+    return dump_my_appointments(db.session.execute(stmt))
 
 
 # read future appointments of the current user
 @appointments_bp.route('/my_appointments/future/')
-@auto.doc()
 @jwt_required()
 def get_future_appointments():
     '''Return all future appointments of the current user.'''
-    if get_jwt()['role'] == 'veterinarian':
-        # get all records from the appointments table which date is later than today's date and with the current veterinarian
-        future_appointments = [appointment for appointment in current_user.appointments if appointment.date > datetime.today().date()]
-        if future_appointments:
-            return AppointmentSchema(many=True, exclude=['veterinarian', 'veterinarian_id']).dump(future_appointments)
-        else:
-            return {'msg': 'No appointments found'}, 404
-    else:
-        # get all records from the appointments table which date is later than today's date and are associated with the current customer throuth the patients table
-        customer_id = current_user.id
-        stmt = db.select(Appointment).join(Patient, Patient.id==Appointment.patient_id).filter(customer_id==customer_id, Appointment.date > datetime.today().date())
-        result = db.session.scalars(stmt).all()
-        if result:
-            return AppointmentSchema(many=True, exclude=['patient']).dump(result)
-        else:
-            return {'msg': 'No appointments found'}, 404
+    # get all records from the appointments table which date is later than today's date and are associated with the current user
+    return dump_my_appointments_on(Appointment.date > datetime.today().date())
 
 
 # read previous appointments of the current user
 @appointments_bp.route('/my_appointments/previous/')
-@auto.doc()
 @jwt_required()
 def get_previous_appointments():
     '''Return all previous appointments of the current user.'''
-    if get_jwt()['role'] == 'veterinarian':
-        # get all records from the appointments table which date is earlier than today's date and with the current veterinarian
-        previous_appointments = [appointment for appointment in current_user.appointments if appointment.date < datetime.today().date()]
-        # future_appointments = current_user.appointments.filter(Appointment.date < datetime.today())
-        if previous_appointments:
-            return AppointmentSchema(many=True, exclude=['veterinarian', 'veterinarian_id']).dump(previous_appointments)
-        else:
-            return {'msg': 'No appointments found'}, 404
-    else:
-        # get all records from the appointments table which date is earlier than today's date and are associated with the current customer throuth the patients table
-        customer_id = current_user.id
-        stmt = db.select(Appointment).join(Patient, Patient.id==Appointment.patient_id).filter(customer_id==customer_id, Appointment.date < datetime.today().date())
-        result = db.session.scalars(stmt).all()
-        if result:
-            return AppointmentSchema(many=True, exclude=['patient']).dump(result)
-        else:
-            return {'msg': 'No appointments found'}, 404
+    # get all records from the appointments table which date is earlier than today's date and are associated with the current user
+    return dump_my_appointments_on(Appointment.date < datetime.today().date())
 
 
 # read today's appointments of the current user
 @appointments_bp.route('/my_appointments/today/')
-@auto.doc()
 @jwt_required()
 def get_today_appointments():
     '''Return all today appointments of the current user.'''
-    if get_jwt()['role'] == 'veterinarian':
-        # get all records from the appointments table which date is today's date and with the current veterinarian
-        today_appointments = [appointment for appointment in current_user.appointments if appointment.date == datetime.today().date()]
-        if today_appointments:
-            return AppointmentSchema(many=True, exclude=['veterinarian', 'veterinarian_id']).dump(today_appointments)
-        else:
-            return {'msg': 'No appointments found'}, 404
+    # get all records from the appointments table which date is today's date and are associated with the current user
+    return dump_my_appointments_on(Appointment.date == datetime.today().date())
+
+
+# collect the dates of the day sheets changed by the flush, which are dropped from the cache once the transaction is committed
+# a change of a patient or a veterinarian (e.g. a new name) can show on any sheet, so it drops all of them
+@event.listens_for(RoutingSession, 'after_flush')
+def collect_schedule_changes(session, flush_context):
+    dates = session.info.setdefault('schedule_dates', set())
+    for record in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(record, Appointment):
+            history = attributes.get_history(record, 'date')
+            dates.update(schedule_key(value) for value in history.sum() if value is not None)
+        elif isinstance(record, Veterinarian) or (isinstance(record, Patient) and record not in session.new):
+            dates.add(None)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def invalidate_schedule_changes(session):
+    invalidate_schedule(*session.info.pop('schedule_dates', ()))
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def discard_schedule_changes(session):
+    session.info.pop('schedule_dates', None)
+
+
+# get the key of the day sheet of the date, which may be a date or a string given in the request, or None if it is not a valid date
+def schedule_key(value):
+    try:
+        return datetime.strptime(str(value), '%Y-%m-%d').date().isoformat()
+    except ValueError:
+        return None
+
+
+# drop the day sheets of the given dates from the cache, or all of them if one of the keys is None
+def invalidate_schedule(*keys):
+    if None in keys:
+        schedule_cache.clear()
+    for key in keys:
+        schedule_cache.pop(key)
+
+
+# build the day sheet of the clinic for the date from one query, i.e. every veterinarian with their appointments on that date,
+# joined with the patients and served by the index on (veterinarian_id, date, time)
+def build_schedule(date):
+    opening, closing = gb.clinic_hours()
+    step = timedelta(minutes=gb.SLOT_MINUTES)
+    times = []
+    slot = datetime.combine(date, opening)
+    while slot.time() < closing:
+        times.append(slot.time())
+        slot += step
+    stmt = db.select(
+        Veterinarian.id.label('veterinarian_id'), Veterinarian.first_name, Veterinarian.last_name,
+        Appointment.id.label('appointment_id'), Appointment.time, Appointment.patient_id,
+        Patient.name.label('patient_name'), Patient.species
+    ).outerjoin(Appointment, db.and_(Appointment.veterinarian_id==Veterinarian.id, Appointment.date==date)).outerjoin(
+        Patient, Patient.id==Appointment.patient_id
+    ).order_by(Veterinarian.id, Appointment.time)
+    with primary():
+        rows = db.session.execute(stmt).all()
+    # an appointment outside the current clinic hours still gets its own row in the sheet
+    times = sorted(set(times) | {row.time for row in rows if row.time is not None})
+    veterinarians = {}
+    for row in rows:
+        veterinarian = veterinarians.get(row.veterinarian_id)
+        if veterinarian is None:
+            veterinarian = veterinarians[row.veterinarian_id] = {
+                'veterinarian_id': row.veterinarian_id,
+                'first_name': row.first_name,
+                'last_name': row.last_name,
+                'appointments': {}
+            }
+        if row.appointment_id is not None:
+            veterinarian['appointments'][row.time] = {
+                'appointment_id': row.appointment_id,
+                'patient_id': row.patient_id,
+                'patient_name': row.patient_name,
+                'species': row.species.name
+            }
+    for veterinarian in veterinarians.values():
+        appointments = veterinarian.pop('appointments')
+        veterinarian['slots'] = [appointments.get(time) for time in times]
+    return {'date': date.isoformat(), 'times': [time.strftime('%H:%M') for time in times], 'veterinarians': list(veterinarians.values())}
+
+
+# read the day sheet of the clinic
+@appointments_bp.route('/schedule')
+@jwt_required()
+def get_schedule():
+    '''Veterinarian interface - Return the day sheet of the clinic for one date, i.e. the grid of every veterinarian by 15-minute slot, with the appointment, patient name and species in each booked slot and null in each free one. The query string argument is date in the format of yyyy-mm-dd, and is optional. The default value is today. The slots are listed in times, and in the same order in the slots of each veterinarian.'''
+    if identity.is_veterinarian():
+        date = gb.date_argument('date', datetime.today().date())
+        return gb.cached_response(schedule_cache, date.isoformat(), lambda: build_schedule(date), current_app.config['SCHEDULE_CACHE_SECONDS'], public=False)
     else:
-        # get all records from the appointments table which date is today's date and are associated with the current customer throuth the patients table
-        customer_id = current_user.id
-        stmt = db.select(Appointment).join(Patient, Patient.id==Appointment.patient_id).filter(customer_id==customer_id, Appointment.date==datetime.today().date())
-        result = db.session.scalars(stmt).all()
-        if result:
-            return AppointmentSchema(many=True, exclude=['patient']).dump(result)
-        else:
-            return {'msg': 'No appointments found'}, 404
+        return {'error': 'You are not a veterinarian.'}, 401
 
 
 # read one appointment
 @appointments_bp.route('/<int:appointment_id>/')
-@auto.doc()
 @jwt_required()
 def get_one_appointment(appointment_id):
     '''Return one appointment with the given id in the format of integer as argument.'''
-    appointment = gb.required_record(Appointment, appointment_id)
-    if gb.is_admin() or is_appointment_authorized_person(appointment_id):
+    appointment, authorized = gb.authorized_record(Appointment, appointment_id, access.appointment_access(), *appointment_loading_plan)
+    if authorized:
         # get one record from the appointments table with the given appointment_id
-        return AppointmentSchema().dump(appointment)
+        return gb.dump(AppointmentSchema, appointment)
     else:
        return {'error': 'You are not authorized to view the information.'}, 401
 
 
 # delete one appointment
 @appointments_bp.route('/<int:appointment_id>/', methods=['DELETE'])
-@auto.doc()
 @jwt_required()
 def delete_appointment(appointment_id):
     '''Admin interface - Delete one appointment with the given id in the format of integer as argument.'''
     appointment = gb.required_record(Appointment, appointment_id)
-    if gb.is_admin():
+    if identity.is_admin():
         # delete one record from the appointments table with the given appointment_id
         db.session.delete(appointment)
         db.session.commit()
@@ -180,27 +347,22 @@ def delete_appointment(appointment_id):
 
 # update one appointment
 @appointments_bp.route('/<int:appointment_id>/', methods=['PUT', 'PATCH'])
-@auto.doc()
 @jwt_required()
 def update_appointment(appointment_id):
     '''Update one appointment with the given id in the format of integer as argument and the key-value pairs as the request body, and then return the updated appointment. The keys are date, time, patient_id and veterinarian_id, and are all optional. The format of the values are: yyyy-mm-dd for date, hh:mm for time and mm should be one of 00, 15, 30 or 45, and integer for patient_id and veterinarian_id.'''
-    appointment = gb.required_record(Appointment, appointment_id)
-    if gb.is_admin() or is_appointment_authorized_person(appointment_id):
+    appointment, authorized = gb.authorized_record(Appointment, appointment_id, access.appointment_access(), *appointment_without_patient_loading_plan)
+    if authorized:
         # update one record in the appointments table with the given appointment_id using the information contained in the request
         for key in list(request.json.keys()):
             setattr(appointment, key, gb.required_value_converter(appointment, key))
         db.session.commit()
-        return AppointmentSchema(exclude=['patient']).dump(appointment)
+        return gb.dump(AppointmentSchema, appointment, exclude=['patient'])
     else:
         return {'error': 'You are not authorized to update the information.'}, 401
 
 
-# create a new appointment
-@appointments_bp.route('/book/', methods=['POST'])
-@auto.doc()
-@jwt_required()
-def appointment_register():
-    '''Book an appointment with the key-value pairs as the request body, and reutrn the appointment created. The keys are date, time, patient_id and veterinarian_id, and are all required. The format of the values are: yyyy-mm-dd for date, hh:mm for time and mm should be one of 00, 15, 30 or 45, and integer for patient_id and veterinarian_id.'''
+# check the booking in the request as for booking one appointment, and return an error if it cannot be made by the current user
+def booking_error():
     date_input = request.json['date']
     date_datetime = datetime.strptime(date_input, '%Y-%m-%d').date()
     today = datetime.today().date()
@@ -213,23 +375,293 @@ def appointment_register():
     gb.required_record(Patient, patient_id_input)
     veterinarian_id_input = request.json['veterinarian_id']
     gb.required_record(Veterinarian, veterinarian_id_input)
-    if get_jwt()['role'] == 'customer':
+    if identity.is_customer():
         customer_id = current_user.id
         # get patients' id from the patients table using the current customer's id
         stmt = db.select(Patient.id).filter_by(customer_id=customer_id)
         result = db.session.scalars(stmt).all()
         if patient_id_input not in result:
             return {'error': 'You are not authorized to book an appointment for this patient.'}, 401
-    elif get_jwt()['role'] == 'veterinarian' and not current_user.is_admin:
+    elif identity.is_veterinarian() and not current_user.is_admin:
         if veterinarian_id_input != current_user.id:
             return {'error': 'You are not authorized to book an appointment for this veterinarian.'}, 401
+
+
+# try to lock the slot of the veterinarian and the slot of the patient until the end of the transaction, without waiting
+# the locks are PostgreSQL advisory locks keyed by the veterinarian id (or the negated patient id) and the number of the slot since 1970-01-01,
+# so the bookings competing for a slot are turned away here instead of failing on the unique constraints at commit
+def lock_slot(date, time, veterinarian_id, patient_id):
+    return lock_slots([{'date': date, 'time': time, 'veterinarian_id': veterinarian_id, 'patient_id': patient_id}])[0]
+
+
+# try to lock the slots of many bookings in the same way, taking the locks of each booking in the same key order as for one booking,
+# and return for each booking if both of its locks were taken
+# the locks of up to LOCK_BATCH_SIZE bookings are taken in one statement
+def lock_slots(bookings):
+    locked = []
+    for start in range(0, len(bookings), LOCK_BATCH_SIZE):
+        locks = []
+        for booking in bookings[start:start + LOCK_BATCH_SIZE]:
+            slot = (booking['date'] - datetime(1970, 1, 1).date()).days * (24 * 60 // gb.SLOT_MINUTES) + (booking['time'].hour * 60 + booking['time'].minute) // gb.SLOT_MINUTES
+            locks += [db.func.pg_try_advisory_xact_lock(booking['veterinarian_id'], slot), db.func.pg_try_advisory_xact_lock(-booking['patient_id'], slot)]
+        row = db.session.execute(db.select(*locks)).one()
+        locked += [row[i] and row[i + 1] for i in range(0, len(row), 2)]
+    return locked
+
+
+# check if the slot is booked for the veterinarian or the patient, or held for one of them, in one query
+# a hold is exclusive also for its own holder, who books the slot by confirming it, so only the hold being confirmed is left out
+def slot_taken(date, time, veterinarian_id, patient_id, hold_id=None):
+    appointment = db.select(Appointment.id).filter(
+        Appointment.date == date, Appointment.time == time,
+        db.or_(Appointment.veterinarian_id == veterinarian_id, Appointment.patient_id == patient_id)
+    )
+    hold = db.select(SlotHold.id).filter(
+        SlotHold.date == date, SlotHold.time == time,
+        db.or_(SlotHold.veterinarian_id == veterinarian_id, SlotHold.patient_id == patient_id),
+        SlotHold.expires_at > datetime.now()
+    )
+    if hold_id is not None:
+        hold = hold.filter(SlotHold.id != hold_id)
+    return db.session.scalar(db.select(db.or_(appointment.exists(), hold.exists())))
+
+
+# lock the slot of the booking in the request and check it is free, and return an error if it is not
+def slot_error(date, time, veterinarian_id, patient_id):
+    if not lock_slot(date, time, veterinarian_id, patient_id):
+        db.session.rollback()
+        return {'error': 'Appointment is being booked by someone else. Please try again.'}, 409
+    if slot_taken(date, time, veterinarian_id, patient_id):
+        db.session.rollback()
+        return {'error': 'Appointment is not available for the required date and time'}, 409
+
+
+# create a new appointment
+@appointments_bp.route('/book/', methods=['POST'])
+@jwt_required()
+def appointment_register():
+    '''Book an appointment with the key-value pairs as the request body, and reutrn the appointment created. The keys are date, time, patient_id and veterinarian_id, and are all required. The format of the values are: yyyy-mm-dd for date, hh:mm for time and mm should be one of 00, 15, 30 or 45, and integer for patient_id and veterinarian_id. A held slot cannot be booked, also by the user who holds it, until the hold is confirmed, released or expires.'''
+    error = booking_error()
+    if error:
+        return error
     # add one record in the appointments table 
     appointment = Appointment(
-        date = date_input,
+        date = request.json['date'],
         time = request.json['time'],
-        veterinarian_id = veterinarian_id_input,
-        patient_id = patient_id_input
+        veterinarian_id = request.json['veterinarian_id'],
+        patient_id = request.json['patient_id']
     )
+    error = slot_error(datetime.strptime(appointment.date, '%Y-%m-%d').date(), gb.time_value(appointment.time), appointment.veterinarian_id, appointment.patient_id)
+    if error:
+        return error
     db.session.add(appointment)
     db.session.commit()
-    return AppointmentSchema(exclude=['patient']).dump(appointment), 201
+    return gb.dump(AppointmentSchema, appointment, exclude=['patient']), 201
+
+
+# hold an appointment slot
+@appointments_bp.route('/hold', methods=['POST'])
+@jwt_required()
+def hold_slot():
+    '''Hold an appointment slot for the current user with the key-value pairs as the request body, and return the hold created with its id and expires_at. The keys and the format of the values are the same as for booking an appointment. Nobody, including the current user, can book or hold the slot for the veterinarian or the patient again until the hold is released or expires, which is 2 minutes by default. The hold is turned into the appointment by confirming it.'''
+    error = booking_error()
+    if error:
+        return error
+    # validate the slot with the same rules as the Appointment model
+    appointment = Appointment(date=request.json['date'], time=request.json['time'], veterinarian_id=request.json['veterinarian_id'], patient_id=request.json['patient_id'])
+    date = datetime.strptime(appointment.date, '%Y-%m-%d').date()
+    time = gb.time_value(appointment.time)
+    error = slot_error(date, time, appointment.veterinarian_id, appointment.patient_id)
+    if error:
+        return error
+    # replace the expired holds of the slot
+    db.session.execute(db.delete(SlotHold).where(
+        SlotHold.date == date, SlotHold.time == time,
+        db.or_(SlotHold.veterinarian_id == appointment.veterinarian_id, SlotHold.patient_id == appointment.patient_id),
+        SlotHold.expires_at <= datetime.now()
+    ).execution_options(synchronize_session=False))
+    hold = SlotHold(
+        date = date,
+        time = time,
+        veterinarian_id = appointment.veterinarian_id,
+        patient_id = appointment.patient_id,
+        holder = identity.current_key(),
+        expires_at = datetime.now() + timedelta(seconds=current_app.config['HOLD_SECONDS'])
+    )
+    db.session.add(hold)
+    db.session.commit()
+    return gb.dump(SlotHoldSchema, hold), 201
+
+
+# get the hold with the given id if it was made by the current user, or return an error
+def required_hold(hold_id):
+    hold = gb.required_record(SlotHold, hold_id)
+    if hold.holder != identity.current_key():
+        return None, ({'error': 'You are not authorized to use this hold.'}, 401)
+    return hold, None
+
+
+# confirm a hold
+@appointments_bp.route('/hold/<int:hold_id>/confirm', methods=['POST'])
+@jwt_required()
+def confirm_hold(hold_id):
+    '''Book the appointment held by the hold with the given id in the format of integer as argument, and return the appointment created. Only the user who made the hold can confirm it, and only before it expires.'''
+    hold, error = required_hold(hold_id)
+    if error:
+        return error
+    if hold.expires_at <= datetime.now():
+        db.session.delete(hold)
+        db.session.commit()
+        return {'error': 'The hold has expired.'}, 410
+    if not lock_slot(hold.date, hold.time, hold.veterinarian_id, hold.patient_id):
+        db.session.rollback()
+        return {'error': 'Appointment is being booked by someone else. Please try again.'}, 409
+    # check the slot again under the lock, as it may have been taken meanwhile, e.g. by an appointment moved into it by an administrator
+    if slot_taken(hold.date, hold.time, hold.veterinarian_id, hold.patient_id, hold.id):
+        db.session.rollback()
+        return {'error': 'Appointment is not available for the required date and time'}, 409
+    appointment = Appointment(
+        date = hold.date.isoformat(),
+        time = hold.time.strftime('%H:%M'),
+        veterinarian_id = hold.veterinarian_id,
+        patient_id = hold.patient_id
+    )
+    db.session.add(appointment)
+    db.session.delete(hold)
+    db.session.commit()
+    return gb.dump(AppointmentSchema, appointment, exclude=['patient']), 201
+
+
+# release a hold
+@appointments_bp.route('/hold/<int:hold_id>', methods=['DELETE'])
+@jwt_required()
+def release_hold(hold_id):
+    '''Release the hold with the given id in the format of integer as argument, so that the slot can be booked by others. Only the user who made the hold can release it.'''
+    hold, error = required_hold(hold_id)
+    if error:
+        return error
+    db.session.delete(hold)
+    db.session.commit()
+    return {'msg': f'Hold of the appointment at {hold.time} on {hold.date} released successfully'}
+
+
+# convert the error raised by an invalid booking in a batch to its message, in the same way as the error handlers of the app
+def batch_error_message(err):
+    if isinstance(err, KeyError):
+        return f'{err.args[0]} is required'
+    return str(err)
+
+
+# create many appointments at once
+@appointments_bp.route('/book/batch', methods=['POST'])
+@jwt_required()
+def appointment_batch_register():
+    '''Book many appointments with a list of bookings as the request body, and return the status of each booking in the same order. Each booking has the keys date, time, patient_id and veterinarian_id as for booking one appointment. The status is created (with the appointment), conflict, unauthorized or invalid (with the error). A booking which fails does not stop the others.'''
+    bookings = request.json
+    if not isinstance(bookings, list):
+        raise TypeError('The request body must be a list of bookings.')
+    if len(bookings) > current_app.config['BOOKING_BATCH_LIMIT']:
+        return {'error': f"At most {current_app.config['BOOKING_BATCH_LIMIT']} bookings can be made at once."}, 403
+    results = [None] * len(bookings)
+    tomorrow = datetime.today().date() + timedelta(days=1)
+    # validate each booking with the same rules as the Appointment model
+    valid = {}
+    for index, booking in enumerate(bookings):
+        try:
+            if not isinstance(booking, dict):
+                raise TypeError('Each booking must be an object.')
+            Appointment(date=booking['date'], time=booking['time'], veterinarian_id=booking['veterinarian_id'], patient_id=booking['patient_id'])
+            if not isinstance(booking['patient_id'], int) or not isinstance(booking['veterinarian_id'], int):
+                raise TypeError('patient_id and veterinarian_id must be integers.')
+            date = datetime.strptime(booking['date'], '%Y-%m-%d').date()
+            time = gb.time_value(booking['time'])
+            if date < tomorrow:
+                raise ValueError('Booking has to be made one day in advance.')
+            valid[index] = {'date': date, 'time': time, 'veterinarian_id': booking['veterinarian_id'], 'patient_id': booking['patient_id']}
+        except (KeyError, TypeError, ValueError) as err:
+            results[index] = {'status': 'invalid', 'error': batch_error_message(err)}
+    # get the owners of the patients and the existing veterinarians of the whole batch, one query each
+    patient_owners = dict(db.session.execute(db.select(Patient.id, Patient.customer_id).filter(Patient.id.in_([row['patient_id'] for row in valid.values()]))).all())
+    veterinarian_ids = set(db.session.scalars(db.select(Veterinarian.id).filter(Veterinarian.id.in_([row['veterinarian_id'] for row in valid.values()]))))
+    # get the slots which are taken already by the veterinarians or the patients of the batch, or held for them, in one query
+    veterinarian_slots = {(row['veterinarian_id'], row['date'], row['time']) for row in valid.values()}
+    patient_slots = {(row['patient_id'], row['date'], row['time']) for row in valid.values()}
+    taken_veterinarian_slots = set()
+    taken_patient_slots = set()
+    # lock the slots of the batch before reading them, so that a slot held or booked meanwhile is either seen below or turned away here
+    locked = dict(zip(valid, lock_slots(list(valid.values()))))
+    if valid:
+        stmt = db.select(Appointment.veterinarian_id, Appointment.patient_id, Appointment.date, Appointment.time).filter(db.or_(
+            db.tuple_(Appointment.veterinarian_id, Appointment.date, Appointment.time).in_(list(veterinarian_slots)),
+            db.tuple_(Appointment.patient_id, Appointment.date, Appointment.time).in_(list(patient_slots))
+        ))
+        # the held slots are taken as well until their holds expire, also for their holders who book them by confirming the holds
+        holds = db.select(SlotHold.veterinarian_id, SlotHold.patient_id, SlotHold.date, SlotHold.time).filter(
+            db.or_(
+                db.tuple_(SlotHold.veterinarian_id, SlotHold.date, SlotHold.time).in_(list(veterinarian_slots)),
+                db.tuple_(SlotHold.patient_id, SlotHold.date, SlotHold.time).in_(list(patient_slots))
+            ),
+            SlotHold.expires_at > datetime.now()
+        )
+        for veterinarian_id, patient_id, date, time in db.session.execute(stmt.union_all(holds)):
+            taken_veterinarian_slots.add((veterinarian_id, date, time))
+            taken_patient_slots.add((patient_id, date, time))
+    rows = {}
+    for index, row in valid.items():
+        veterinarian_slot = (row['veterinarian_id'], row['date'], row['time'])
+        patient_slot = (row['patient_id'], row['date'], row['time'])
+        if row['patient_id'] not in patient_owners:
+            results[index] = {'status': 'invalid', 'error': f"Patient with id {row['patient_id']} not found"}
+        elif row['veterinarian_id'] not in veterinarian_ids:
+            results[index] = {'status': 'invalid', 'error': f"Veterinarian with id {row['veterinarian_id']} not found"}
+        elif identity.is_customer() and patient_owners[row['patient_id']] != current_user.id:
+            results[index] = {'status': 'unauthorized', 'error': 'You are not authorized to book an appointment for this patient.'}
+        elif identity.is_veterinarian() and not current_user.is_admin and row['veterinarian_id'] != current_user.id:
+            results[index] = {'status': 'unauthorized', 'error': 'You are not authorized to book an appointment for this veterinarian.'}
+        elif not locked[index]:
+            results[index] = {'status': 'conflict', 'error': 'Appointment is being booked by someone else. Please try again.'}
+        elif veterinarian_slot in taken_veterinarian_slots or patient_slot in taken_patient_slots:
+            results[index] = {'status': 'conflict', 'error': 'Appointment is not available for the required date and time'}
+        else:
+            # the later bookings in the batch conflict with this one
+            taken_veterinarian_slots.add(veterinarian_slot)
+            taken_patient_slots.add(patient_slot)
+            rows[veterinarian_slot] = index
+    # add the bookings left in the appointments table in one statement, skipping the ones taken by a concurrent booking meanwhile
+    if rows:
+        stmt = insert(Appointment).values([valid[index] for index in rows.values()]).on_conflict_do_nothing().returning(
+            Appointment.id, Appointment.date, Appointment.time, Appointment.veterinarian_id, Appointment.patient_id
+        )
+        created = db.session.execute(stmt).all()
+        # the bookings are inserted without the ORM, so their weeks are marked for the analytics and their day sheets are dropped here
+        analytics.mark_weeks(db.session.connection(), [appointment.date for appointment in created])
+        db.session.commit()
+        invalidate_schedule(*{schedule_key(appointment.date) for appointment in created})
+        schema = gb.schema(AppointmentSchema, only=['id', 'date', 'time', 'veterinarian_id', 'patient_id'])
+        with timed('serialize'):
+            for appointment in created:
+                index = rows.pop((appointment.veterinarian_id, appointment.date, appointment.time))
+                results[index] = {'status': 'created', 'appointment': schema.dump(appointment._mapping)}
+        for index in rows.values():
+            results[index] = {'status': 'conflict', 'error': 'Appointment is not available for the required date and time'}
+    return {'created': sum(result['status'] == 'created' for result in results), 'results': results}
+
+
+# send the reminders of the appointments on one date (tomorrow by default) to the customers
+# the reminders are sent concurrently through the sink, and each appointment is marked once its reminder is sent, so the command can be rerun safely
+@appointments_bp.cli.command('remind')
+@click.option('--date', 'date_input', type=click.DateTime(formats=['%Y-%m-%d']), help='Date of the appointments in the format of yyyy-mm-dd. Defaults to tomorrow.')
+@click.option('--sink', type=click.Choice(['file', 'smtp']), help='Where the reminders are sent. Defaults to REMINDER_SINK.')
+@click.option('--concurrency', type=int, help='Number of reminders sent at the same time. Defaults to REMINDER_CONCURRENCY.')
+@click.option('--retries', type=int, help='Number of retries of a reminder which fails. Defaults to REMINDER_RETRIES.')
+@click.option('--batch-size', default=500, show_default=True, help='Number of appointments read and marked at once.')
+def remind_appointments(date_input, sink, concurrency, retries, batch_size):
+    config = current_app.config
+    date = date_input.date() if date_input else datetime.today().date() + timedelta(days=1)
+    started = datetime.now()
+    sent, failed = reminders.remind(
+        date, reminders.make_sink(config, sink), concurrency or config['REMINDER_CONCURRENCY'],
+        config['REMINDER_RETRIES'] if retries is None else retries, config['REMINDER_BACKOFF_SECONDS'], batch_size
+    )
+    elapsed = (datetime.now() - started).total_seconds()
+    print(f'{sent} reminders sent and {failed} failed for {date.isoformat()} in {elapsed:.1f}s')
@@ -1,20 +1,110 @@
 from flask import Blueprint
-from init import db, bcrypt
+from flask.cli import with_appcontext
+import click
+import csv, json, os, time
+import gb
+import analytics
+import partitions
+from init import db, hasher
 from models.customer import Customer
 from models.veterinarian import Veterinarian
-from models.patient import Patient
+from models.patient import Patient, SpeciesEnum
 from models.appointment import Appointment
+from models.token_block_list import TokenBlocklist
+from sqlalchemy.exc import IntegrityError, DataError
 from datetime import datetime
 
 
 db_commands = Blueprint('db', __name__)
 
+# the tables which can be imported, with their columns and the functions converting the values read from the file
+IMPORT_MODELS = {'customers': Customer, 'patients': Patient, 'appointments': Appointment}
+IMPORT_COLUMNS = {
+    'customers': {'first_name': str, 'last_name': str, 'email': str, 'password': str, 'contact_number': str},
+    'patients': {'name': str, 'age': int, 'weight': float, 'sex': str, 'species': str, 'customer_id': int},
+    'appointments': {'date': str, 'time': str, 'veterinarian_id': int, 'patient_id': int}
+}
+
+
+# read the rows of a CSV or NDJSON file one by one, together with their line numbers
+# a line of an NDJSON file which is not a JSON object is rejected with reject() and skipped, so it does not stop the import
+def read_rows(file, reject):
+    with open(file, newline='') as f:
+        if file.endswith('.csv'):
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+        else:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError as err:
+                    reject(line_number, line.rstrip('\n'), f'Invalid JSON - {err}')
+                    continue
+                if not isinstance(row, dict):
+                    reject(line_number, row, 'Each row must be an object.')
+                    continue
+                yield line_number, row
+
+
+# convert and validate one row with the same rules as the model, and return the values to insert
+def import_values(table, row):
+    values = {}
+    for key, convert in IMPORT_COLUMNS[table].items():
+        # a missing value (i.e. null in NDJSON or a short line in CSV) is rejected rather than converted, e.g. to 'None' by str
+        if row.get(key) is None:
+            raise KeyError(key)
+        try:
+            values[key] = convert(row[key])
+        except (TypeError, ValueError):
+            raise ValueError(f'Invalid {key}')
+    # creating the model object runs its @validates hooks, the object itself is not added to the session
+    IMPORT_MODELS[table](**values)
+    if table == 'customers':
+        gb.validate_password(values['password'])
+    elif table == 'patients' and values['species'] not in SpeciesEnum.__members__:
+        raise ValueError('Invalid species - Species must be dog, cat, bird, fish or rabbit')
+    elif table == 'appointments':
+        values['date'] = datetime.strptime(values['date'], '%Y-%m-%d').date()
+    return values
+
+
+# insert the rows of one chunk with one executemany in a savepoint
+# if the database rejects the chunk, insert its rows one by one to find the rejected ones
+def insert_chunk(model, chunk, reject):
+    try:
+        with db.session.begin_nested():
+            db.session.execute(db.insert(model), [values for _, _, values in chunk])
+        return len(chunk)
+    except (IntegrityError, DataError):
+        inserted = 0
+        for line_number, row, values in chunk:
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(db.insert(model), [values])
+                inserted += 1
+            except (IntegrityError, DataError) as err:
+                reject(line_number, row, str(err.orig).strip())
+        return inserted
+
 
 # create all defined tables in the database
+# with --partitioned, the appointments table is partitioned by month, with the partitions of the current month and the months ahead
 @db_commands.cli.command('create')
-def create_db():
-    db.create_all()
-    print('Tables created')
+@click.option('--partitioned', is_flag=True, help='Partition the appointments table by month (PostgreSQL only).')
+@click.option('--months', default=3, show_default=True, help='Number of months ahead to create the partitions of, with --partitioned.')
+def create_db(partitioned, months):
+    if partitioned:
+        partitions.create_partitioned_tables()
+        this_month = partitions.month_start(datetime.today())
+        for offset in range(months + 1):
+            partitions.create_partition(partitions.month_start(this_month, offset))
+        print(f'Tables created with the appointments partitioned by month from {this_month.isoformat()}')
+    else:
+        db.create_all()
+        print('Tables created')
 
 
 # drop all tables in the database
@@ -24,6 +114,133 @@ def drop_db():
     print('Tables droped')
 
 
+# manage the monthly partitions of the appointments table
+@db_commands.cli.group('partitions')
+@with_appcontext
+def partitions_db():
+    if not partitions.is_partitioned():
+        raise click.ClickException('The appointments table is not partitioned - Create it with flask db create --partitioned')
+
+
+# get the first month which is kept attached, i.e. keep_months before the current month
+def first_kept_month(keep_months):
+    return partitions.month_start(datetime.today(), -keep_months)
+
+
+# create the partitions of the months from the given month (the current month by default) to the given number of months ahead of the current month
+@partitions_db.command('create')
+@click.option('--months', default=3, show_default=True, help='Number of months ahead of the current month to create the partitions of.')
+@click.option('--from', 'month_from', type=click.DateTime(formats=['%Y-%m']), help='First month in the format of yyyy-mm, e.g. to move the past appointments out of the default partition. Defaults to the current month.')
+def create_partitions(months, month_from):
+    this_month = partitions.month_start(datetime.today())
+    month = partitions.month_start(month_from) if month_from else this_month
+    created = 0
+    while month <= partitions.month_start(this_month, months):
+        if partitions.create_partition(month):
+            print(f'{partitions.partition_name(month)} created')
+            created += 1
+        month = partitions.month_start(month, 1)
+    print(f'{created} partitions created')
+
+
+# detach the partitions older than the months kept, so their appointments are no longer queried
+@partitions_db.command('detach')
+@click.option('--keep-months', default=12, show_default=True, help='Number of months before the current month which stay attached.')
+def detach_partitions(keep_months):
+    first_month = first_kept_month(keep_months)
+    old = sorted((month, name) for month, name in partitions.attached_partitions().items() if month < first_month)
+    for _, name in old:
+        partitions.detach_partition(name)
+        print(f'{name} detached')
+    print(f'{len(old)} partitions detached')
+
+
+# write the partitions older than the months kept to compressed files and drop them, one partition per transaction
+@partitions_db.command('archive')
+@click.option('--keep-months', default=12, show_default=True, help='Number of months before the current month which are not archived.')
+@click.option('--output-dir', default='archive', show_default=True, type=click.Path(file_okay=False), help='Directory the gzip compressed CSV files are written to.')
+def archive_partitions(keep_months, output_dir):
+    first_month = first_kept_month(keep_months)
+    old = {**partitions.attached_partitions(), **partitions.detached_partitions()}
+    old = sorted((month, name) for month, name in old.items() if month < first_month)
+    for _, name in old:
+        path = partitions.archive_partition(name, output_dir)
+        print(f'{name} archived to {path}')
+    print(f'{len(old)} partitions archived')
+
+
+# delete the revoked tokens which have expired, in batches so that each transaction stays short
+@db_commands.cli.command('prune-tokens')
+@click.option('--batch-size', default=1000, show_default=True, help='Number of rows deleted in each transaction.')
+def prune_tokens(batch_size):
+    pruned = 0
+    while True:
+        expired = db.select(TokenBlocklist.id).filter(TokenBlocklist.expires_at < datetime.now()).limit(batch_size)
+        stmt = db.delete(TokenBlocklist).where(TokenBlocklist.id.in_(expired)).execution_options(synchronize_session=False)
+        deleted = db.session.execute(stmt).rowcount
+        db.session.commit()
+        pruned += deleted
+        if deleted < batch_size:
+            break
+    print(f'{pruned} expired tokens pruned')
+
+
+# import the rows of a CSV or NDJSON file into the customers, patients or appointments table
+# the rows are validated like the models do, inserted in chunks with executemany and committed chunk by chunk
+# the customers' passwords are hashed across the worker processes of the password hasher
+# the rejected rows are written to an NDJSON errors file with their line numbers and errors
+@db_commands.cli.command('import')
+@click.argument('file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--table', type=click.Choice(list(IMPORT_MODELS)), help='Table to import into. Defaults to the name of the file, e.g. patients.csv.')
+@click.option('--chunk-size', default=5000, show_default=True, help='Number of rows inserted in each transaction.')
+@click.option('--errors', 'errors_file', type=click.Path(dir_okay=False), help='File for the rejected rows. Defaults to the file name with .errors.ndjson.')
+def import_db(file, table, chunk_size, errors_file):
+    table = table or os.path.basename(file).split('.')[0]
+    if table not in IMPORT_MODELS:
+        raise click.BadParameter(f'Cannot tell the table from the file name, use --table with one of {", ".join(IMPORT_MODELS)}')
+    model = IMPORT_MODELS[table]
+    errors_file = errors_file or os.path.splitext(file)[0] + '.errors.ndjson'
+    imported = 0
+    rejected = 0
+    started = time.perf_counter()
+    with open(errors_file, 'w') as errors:
+        def reject(line_number, row, error):
+            nonlocal rejected
+            rejected += 1
+            errors.write(json.dumps({'line': line_number, 'row': row, 'error': error}) + '\n')
+
+        def flush(chunk):
+            nonlocal imported
+            if table == 'customers':
+                for (_, _, values), hashed in zip(chunk, hasher.hash_many([values['password'] for _, _, values in chunk])):
+                    values['password'] = hashed
+            imported += insert_chunk(model, chunk, reject)
+            # the rows are inserted without the ORM, so the weeks of the appointments are marked for the analytics here
+            if table == 'appointments':
+                analytics.mark_weeks(db.session.connection(), [values['date'] for _, _, values in chunk])
+            db.session.commit()
+            elapsed = time.perf_counter() - started
+            print(f'{imported} rows imported, {rejected} rejected ({imported / elapsed:.0f} rows/s)')
+
+        chunk = []
+        for line_number, row in read_rows(file, reject):
+            try:
+                chunk.append((line_number, row, import_values(table, row)))
+            except KeyError as err:
+                reject(line_number, row, f'{err.args[0]} is required')
+            except (TypeError, ValueError) as err:
+                reject(line_number, row, str(err))
+            if len(chunk) >= chunk_size:
+                flush(chunk)
+                chunk = []
+        if chunk:
+            flush(chunk)
+    elapsed = time.perf_counter() - started
+    print(f'{table}: {imported} rows imported and {rejected} rejected in {elapsed:.1f}s ({imported / elapsed:.0f} rows/s)')
+    if rejected:
+        print(f'Rejected rows written to {errors_file}')
+
+
 # seed all tables (i.e. customers, patients, appointments, veterinarians) in the database
 @db_commands.cli.command('seed')
 def seed_db():
@@ -32,21 +249,21 @@ def seed_db():
             first_name = 'Harry',
             last_name = 'Porter',
             email = 'harryporter@test.com',
-            password = bcrypt.generate_password_hash('HarryPorter1!').decode('utf-8'),
+            password = hasher.hash('HarryPorter1!'),
             contact_number = '0412341234'
         ),
         Customer(
             first_name = 'Ham',
             last_name = 'Port',
             email = 'hamport@test.com',
-            password = bcrypt.generate_password_hash('Hamport1!').decode('utf-8'),
+            password = hasher.hash('Hamport1!'),
             contact_number = '0412344321'
         ),
         Customer(
             first_name = 'Rod',
             last_name = 'Stone',
             email = 'rodstone@test.com',
-            password = bcrypt.generate_password_hash('Rodstone2$').decode('utf-8'),
+            password = hasher.hash('Rodstone2$'),
             contact_number = '0733441234'
         )
     ]
@@ -57,7 +274,7 @@ def seed_db():
             first_name = 'Sam',
             last_name = 'Sky',
             email = 'samsky@vet.com',
-            password = bcrypt.generate_password_hash('Samsky1?').decode('utf-8'),
+            password = hasher.hash('Samsky1?'),
             description = 'Lorem ipsum dolor sit amet.',
             sex = 'Male',
             languages = ['Korean', 'French'],
@@ -67,7 +284,7 @@ def seed_db():
             first_name = 'Sammy',
             last_name = 'Soil',
             email = 'sammysoil@vet.com',
-            password = bcrypt.generate_password_hash('sammys1!').decode('utf-8'),
+            password = hasher.hash('sammys1!'),
             description = 'Lorem ipsum dolor sit amet lorem ipsum dolor sit amet.',
             sex = 'Female'
         ),
@@ -75,14 +292,14 @@ def seed_db():
             first_name = 'Gigi',
             last_name = 'Sky',
             email = 'gigisky@vet.com',
-            password = bcrypt.generate_password_hash('gigis11!').decode('utf-8'),
+            password = hasher.hash('gigis11!'),
             sex = 'Male'
         ),
         Veterinarian(
             first_name = 'Lucy',
             last_name = 'Land',
             email = 'luckland@vet.com',
-            password = bcrypt.generate_password_hash('lland01!').decode('utf-8'),
+            password = hasher.hash('lland01!'),
             sex = 'Female'
         )
     ]
@@ -1,103 +1,94 @@
 from flask import Blueprint, request
-from init import db, bcrypt, jwt, auto
+from init import db, hasher
 from flask_jwt_extended import jwt_required, create_access_token, current_user, get_jwt
 from models.customer import CustomerSchema, Customer
 from models.appointment import Appointment
-from models.patient import Patient
-from models.token_block_list import TokenBlocklist
+from models.patient import Patient, PatientSchema
+from controllers.appointments_controller import customer_appointments_stmt, dump_customer_appointment_row
+from revocation import revocation
 import gb
+import identity
+import access
 from datetime import timedelta, datetime
+from sqlalchemy.orm import selectinload
 
 
 customers_bp = Blueprint('customers', __name__, url_prefix='/customers')
 
-
-# check if the veterinarian who has logged in has been authorized 
-def is_authorized_veterinarians(customer_id):
-    id = gb.get_veterinarian_id()
-    if id:
-        # by joining the appointments and patients tables and using the given customer id, get one record from the appointments table with the appointment_id obtained from the token
-        # i.e. get one appointment which is related to both the given customer id and the obtained veterinarian id
-        stmt = db.select(Appointment).filter_by(veterinarian_id=id).join(Patient, Patient.id==Appointment.patient_id).filter_by(customer_id=customer_id) 
-        result = db.session.scalar(stmt)
-        if result:
-            return True         
-
-
-# check if the customer who has logged in has been authorized 
-def is_authorized_customer(customer_id):
-    id = gb.get_customer_id()
-    if id == customer_id:
-        return True
-
-
-@jwt.token_in_blocklist_loader
-def check_if_token_revoked(jwt_header, jwt_payload):
-    jti = jwt_payload["jti"]
-    stmt = db.select(TokenBlocklist).filter_by(jti=jti)
-    token = db.session.scalar(stmt)
-    return token is not None
-
-
-@jwt.revoked_token_loader
-def revoked_token(jwt_header, jwt_payload):
-    return {'error': "You haven't logged into the app yet."}, 401
-    
-
-@jwt.user_lookup_loader
-def user_lookup_callback(_jwt_header, jwt_data):
-    identity = jwt_data['sub']
-    return Customer.query.filter_by(id=identity).one_or_none()
+# the relationships serialized by CustomerSchema, loaded together with the customers to avoid one query per customer, patient and appointment
+# i.e. the patients, their appointments and the veterinarians of the appointments
+customer_loading_plan = [selectinload(Customer.patients).selectinload(Patient.appointments).joinedload(Appointment.veterinarian)]
 
 
 # read all customers
 @customers_bp.route('/')
-@auto.doc()
 @jwt_required()
 def get_all_customers():
-    '''Admin interface - Return the full details of all customers.'''
-    if gb.is_admin():
-        # get all records from the customers table in the database
-        customers = gb.filter_all_records(Customer)
-        return CustomerSchema(many=True).dump(customers)
-    else:
-        return {'error': 'You are not an administrator.'}, 401
+    '''Return the full details of one page of the customers the current user can access, ordered by id, i.e. all customers for an administrator, the customers who have appointments with the current veterinarian, or the current customer. The query string arguments are limit and after for paging, and email and last_name for filtering, and are all optional. The format of the values are: integer for limit and after, and string for email and last_name. The Link header contains the URL of the next page, if any.'''
+    # get one page of the records from the customers table in the database which the current user can access and match the filters
+    stmt = db.select(Customer).filter(access.customer_access()).options(*customer_loading_plan)
+    email = request.args.get('email')
+    last_name = request.args.get('last_name')
+    if email:
+        stmt = stmt.filter(Customer.email == email)
+    if last_name:
+        stmt = stmt.filter(Customer.last_name == last_name)
+    customers, headers = gb.paginate(stmt, Customer)
+    return gb.dump(CustomerSchema, customers, many=True), 200, headers
 
 
 # read current customer's profile
 @customers_bp.route('/my_profile/')
-@auto.doc()
 @jwt_required()
 def my_profile():
     '''Return the profile of the current customer excluding patients.'''
-    if get_jwt()['role'] == 'customer':
-        return CustomerSchema(only=['id', 'first_name', 'last_name', 'contact_number', 'email']).dump(current_user)
+    if identity.is_customer():
+        return gb.dump(CustomerSchema, current_user, only=['id', 'first_name', 'last_name', 'contact_number', 'email'])
+    else:
+        return {'error': 'You are not an customer'}, 401
+
+
+# read everything the customer app shows on opening
+@customers_bp.route('/my_dashboard/')
+@jwt_required()
+def my_dashboard():
+    '''Return the profile of the current customer excluding patients, their patients excluding appointments, and their upcoming appointments (from now on, in date and time order) with the veterinarians, in one response.'''
+    if identity.is_customer():
+        # the profile is the customer loaded for the token, then one query for the patients and one for the appointments with the veterinarians
+        profile = gb.dump(CustomerSchema, current_user, only=['id', 'first_name', 'last_name', 'contact_number', 'email'])
+        patients = db.session.scalars(db.select(Patient).filter_by(customer_id=current_user.id).order_by(Patient.id))
+        now = datetime.now()
+        upcoming = db.or_(Appointment.date > now.date(), db.and_(Appointment.date == now.date(), Appointment.time >= now.time()))
+        appointments = db.session.execute(customer_appointments_stmt(current_user.id).filter(upcoming))
+        return {
+            'profile': profile,
+            'patients': gb.dump(PatientSchema, patients, many=True, only=['id', 'name', 'age', 'weight', 'sex', 'species']),
+            'appointments': [dump_customer_appointment_row(row) for row in appointments]
+        }
     else:
         return {'error': 'You are not an customer'}, 401
 
 
 # read one customer
 @customers_bp.route('/<int:customer_id>/')
-@auto.doc()
 @jwt_required()
 def get_one_customer(customer_id):
     '''Return the full details of one customer with the given id in the format of integer as argument.'''
-    customer = gb.required_record(Customer, customer_id)
-    if gb.is_admin() or is_authorized_customer(customer_id) or is_authorized_veterinarians(customer_id):
+    customer, authorized = gb.authorized_record(Customer, customer_id, access.customer_access(), *customer_loading_plan)
+    if authorized:
         # get one record from the customers table in the database with the given customer id
-        return CustomerSchema().dump(customer)
+        return gb.dump(CustomerSchema, customer)
     else:
         return {'error': 'You are not authorized to view the information.'}, 401
 
 
 # delete one customer
 @customers_bp.route('/<int:customer_id>/', methods=['DELETE'])
-@auto.doc()
 @jwt_required()
 def delete_customer(customer_id):
     '''Admin interface - Delete one customer with the given id in the format of integer as argument.'''
     customer = gb.required_record(Customer, customer_id)
-    if gb.is_admin():
+    if identity.is_admin():
         # delete one record from the customers table in the database with the given customer id
         db.session.delete(customer)
         db.session.commit()
@@ -108,24 +99,22 @@ def delete_customer(customer_id):
 
 # update one customer's details
 @customers_bp.route('/<int:customer_id>/', methods=['PUT', 'PATCH'])
-@auto.doc()
 @jwt_required()
 def update_customer(customer_id):
     '''Update one customer with the given id in the format of integer as argument and the key-value pairs as request body, and return the updated full details of the customer. The keys are first_name, last_name, email, password and contact_number, and are all optional. The format of the values are: non-empty string for first_name and last_name with the maximum length of 25 characters, string for email with the maximum length of 50 characters, string for password with the mininum length of 8 characters and containing at lease one letter, one number and one special character, and string for contact_number with the fixed length of 10 characters.'''
-    customer = gb.required_record(Customer, customer_id)
-    if gb.is_admin() or is_authorized_customer(customer_id) or is_authorized_veterinarians(customer_id):
+    customer, authorized = gb.authorized_record(Customer, customer_id, access.customer_access(), *customer_loading_plan)
+    if authorized:
         # update one record in the customers table in the database with the given customer id using the information contained in the request
         for key in list(request.json.keys()):
             setattr(customer, key, gb.required_value_converter(customer, key))
         db.session.commit()
-        return CustomerSchema().dump(customer)
+        return gb.dump(CustomerSchema, customer)
     else:
         return {'error': 'You are not authorized to update the information.'}, 401
 
 
 # create a new customer
 @customers_bp.route('/register/', methods=['POST'])
-@auto.doc()
 def customer_register():
     '''Customer registration with key-value pairs, and return the full details of the customer registered. The keys are first_name, last_name, email, password and contact_number, and are all required. The format of the values are: non-empty string for first_name and last_name with the maximum length of 25 characters, string for email with the maximum length of 50 characters, string for password with the mininum length of 8 characters and containing at lease one letter, one number and one special character, and string for contact_number with the fixed length of 10 characters.'''
     password_input = request.json['password']
@@ -136,27 +125,26 @@ def customer_register():
         last_name = request.json['last_name'],
         contact_number = request.json['contact_number'],
         email = request.json['email'],
-        password = bcrypt.generate_password_hash(password_input).decode('utf-8')
+        password = hasher.hash(password_input)
     )
     db.session.add(customer)
     db.session.commit()
-    return CustomerSchema().dump(customer), 201
+    return gb.dump(CustomerSchema, customer), 201
 
 
 # customer authentication
 @customers_bp.route('/login/', methods=['POST'])
-@auto.doc()
 def customer_login():
     '''Customer login with the key-value pairs for email and password as request body, and return the email of and the token for the customer.'''
     email=request.json['email']
     password = request.json['password']
     # get one record from the customers table in the database with the given email
     customer = gb.filter_one_record_by_email(Customer, email)
-    if customer and bcrypt.check_password_hash(customer.password, password):
+    if customer and gb.check_password(customer, password):
         # identity = ''.join(['C', str(customer.id)])
-        identity = str(customer.id)
         additional_claims = {'role': 'customer'}
-        token = create_access_token(identity=identity, expires_delta=timedelta(days=1), additional_claims=additional_claims)
+        token = create_access_token(identity=str(customer.id), expires_delta=timedelta(days=1), additional_claims=additional_claims)
+        identity.logged_in('customer', customer.id)
         return {'email': customer.email, 'token': token}
     else:
         return {'error': 'Invalid email or passord'}, 401
@@ -164,14 +152,11 @@ def customer_login():
 
 # JWT revoking
 @customers_bp.route('/logout', methods=['DELETE'])
-@auto.doc()
 @jwt_required()
 def revoke_token():
     '''Customer logout.'''
-    jti = get_jwt()["jti"]
-    now = datetime.now()
-    db.session.add(TokenBlocklist(jti=jti, created_at=now))
-    db.session.commit()
+    jwt_data = get_jwt()
+    revocation.revoke(jwt_data['jti'], datetime.fromtimestamp(jwt_data['exp']))
     return {'msg': 'You logged out successfully'}
 
 
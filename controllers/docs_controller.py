@@ -0,0 +1,43 @@
+from flask import Blueprint, current_app
+import click
+import json
+import docs
+import gb
+from cache import LRUCache
+
+
+docs_bp = Blueprint('docs', __name__)
+
+# the OpenAPI document and the documentation page, built once in each process (or before the fork by warm_up) and then answered
+# from memory with their ETags, as they only change with the code
+documents = LRUCache(max_size=2)
+
+
+# read the OpenAPI document of the API
+@docs_bp.route('/documentation/openapi.json')
+def openapi():
+    return gb.cached_response(documents, 'openapi.json', lambda: docs.build_spec(current_app))
+
+
+# read the documentation page of the API
+@docs_bp.route('/documentation')
+def documentation():
+    return gb.cached_response(documents, 'documentation.html', lambda: docs.build_html(docs.build_spec(current_app)), mimetype='text/html')
+
+
+# build the OpenAPI document and the documentation page of the app into the cache, e.g. before the workers are forked
+def build_documents(app):
+    with app.test_request_context('/documentation'):
+        openapi()
+        documentation()
+
+
+# write the OpenAPI document of the API to a file, e.g. to publish it or to generate a client
+@docs_bp.cli.command('build')
+@click.option('--output', default='openapi.json', show_default=True, type=click.Path(dir_okay=False), help='JSON file the OpenAPI document is written to.')
+def build_docs(output):
+    spec = docs.build_spec(current_app)
+    with open(output, 'w') as f:
+        json.dump(spec, f, indent=2, sort_keys=True)
+    operations = sum(len(methods) for methods in spec['paths'].values())
+    print(f'OpenAPI document of {operations} operations written to {output}')
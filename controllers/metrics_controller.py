@@ -0,0 +1,19 @@
+from flask import Blueprint, current_app, request
+import hmac
+from instrumentation import instrumentation
+
+
+metrics_bp = Blueprint('metrics', __name__)
+
+
+# read the metrics of the requests served by this process
+# the scraper authenticates with the static token of METRICS_TOKEN rather than a user's token, as those expire after a day
+@metrics_bp.route('/metrics')
+def get_metrics():
+    '''Return the histograms of the duration, database time, SQL statements and timed sections of the requests served by this process per endpoint, in the Prometheus text format. The metrics are only served with INSTRUMENTATION_ENABLED and METRICS_TOKEN set, and the request must send METRICS_TOKEN as bearer token (e.g. bearer_token in the scrape configuration of Prometheus).'''
+    token = current_app.config['METRICS_TOKEN']
+    if not current_app.config['INSTRUMENTATION_ENABLED'] or not token:
+        return {'error': 'The metrics are not enabled.'}, 404
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return {'error': 'You are not authorized to read the metrics.'}, 401
+    return instrumentation.metrics()
@@ -1,95 +1,137 @@
 from flask import Blueprint, request
 import gb
+import identity
+import access
 from models.patient import PatientSchema, Patient
-from models.customer import Customer
-from models.veterinarian import Veterinarian
 from models.appointment import Appointment
-from init import db, jwt, auto
-from flask_jwt_extended import jwt_required, current_user, get_jwt
+from models.customer import Customer
+from init import db
+from flask_jwt_extended import jwt_required, current_user
+from sqlalchemy.orm import selectinload, joinedload, contains_eager
 
 
 patients_bp = Blueprint('patients', __name__, url_prefix='/patients')
 
-
-# check if the person who has logged in has been authorized
-def is_patient_authorized_person(patient_id):
-    customer_id = gb.get_customer_id()
-    veterinarian_id = gb.get_veterinarian_id()
-    if customer_id:
-        # get one record from the patients table with the given patient id and the customer id obtained from the token
-        stmt = db.select(Patient).filter_by(customer_id=customer_id, id=patient_id)
-        result = db.session.scalar(stmt)
-        if result:
-            return True
-    elif veterinarian_id:
-        # get one record from the appointments table with the given patient id and the veterinarian id obtained from the token
-        stmt = db.select(Appointment).filter_by(veterinarian_id=veterinarian_id, patient_id=patient_id)
-        result = db.session.scalar(stmt)
-        if result:
-            return True
-
-
-@jwt.user_lookup_loader
-def user_lookup_callback(_jwt_header, jwt_data):
-    identity = jwt_data['sub']
-    if jwt_data['role'] == 'veterinarian':
-        return Veterinarian.query.filter_by(id=identity).one_or_none()
-    else:
-        return Customer.query.filter_by(id=identity).one_or_none()
+# the relationships serialized by PatientSchema, loaded together with the patients to avoid one query per patient and appointment
+# i.e. the customer, the appointments and the veterinarians of the appointments
+patient_loading_plan = [joinedload(Patient.customer), selectinload(Patient.appointments).joinedload(Appointment.veterinarian)]
+# the same for PatientSchema excluding the customer
+patient_without_customer_loading_plan = [selectinload(Patient.appointments).joinedload(Appointment.veterinarian)]
 
 
 # read all patients
 @patients_bp.route('/')
-@auto.doc()
 @jwt_required()
 def get_all_patients():
-    '''Admin interface - Return the full details of all the patients.'''
-    if gb.is_admin():
-        # get all records from the patients table in the database
-        stmt = db.select(Patient)
-        patients = db.session.scalars(stmt)
-        return PatientSchema(many=True).dump(patients)
+    '''Return the full details of one page of the patients the current user can access, ordered by id, i.e. all patients for an administrator, the patients who have appointments with the current veterinarian, or the patients of the current customer. The query string arguments are limit and after for paging, and species, sex and customer_id for filtering, and are all optional. The format of the values are: integer for limit, after and customer_id, dog, cat, bird, fish or rabbit for species, and Female or Male for sex. The Link header contains the URL of the next page, if any.'''
+    # get one page of the records from the patients table in the database which the current user can access and match the filters
+    stmt = db.select(Patient).filter(access.patient_access()).options(*patient_loading_plan)
+    species = request.args.get('species')
+    sex = request.args.get('sex')
+    customer_id = gb.int_argument('customer_id')
+    if species:
+        stmt = stmt.filter(Patient.species == species)
+    if sex:
+        stmt = stmt.filter(Patient.sex == sex)
+    if customer_id:
+        stmt = stmt.filter(Patient.customer_id == customer_id)
+    patients, headers = gb.paginate(stmt, Patient)
+    return gb.dump(PatientSchema, patients, many=True), 200, headers
+
+
+# export all patients
+@patients_bp.route('/export')
+@jwt_required()
+def export_patients():
+    '''Admin interface - Stream all patients ordered by id as NDJSON or CSV. The query string argument is format (ndjson or csv, ndjson by default), and is optional.'''
+    if identity.is_admin():
+        stmt = db.select(Patient.id, Patient.name, Patient.age, Patient.weight, Patient.sex, Patient.species, Patient.customer_id).order_by(Patient.id)
+        return gb.export_response(stmt, 'patients')
     else:
         return {'error': 'You are not an administrator.'}, 401
 
 
+# get the case-insensitive condition that the column starts with the word, with the wildcards in the word matched literally
+def prefix_condition(column, word):
+    pattern = word.replace('!', '!!').replace('%', '!%').replace('_', '!_') + '%'
+    return column.ilike(pattern, escape='!')
+
+
+# get the condition matching one word of a search against the column, i.e. the column starts with the word or is similar to it (pg_trgm)
+# both are served by the trigram index of the column
+def search_condition(column, word):
+    return db.or_(prefix_condition(column, word), column.op('%')(word))
+
+
+# get the ids of the patients matching one word of a search, i.e. by the name of the patient or by the names or email of its customer
+# each side of the union filters one table only, so both are served by the trigram indexes, and the patients of the matching customers by customer_patient_uc
+def matching_patient_ids(word):
+    by_name = db.select(Patient.id).filter(search_condition(Patient.name, word))
+    customers = db.select(Customer.id).filter(db.or_(*[search_condition(column, word) for column in [Customer.first_name, Customer.last_name, Customer.email]]))
+    by_customer = db.select(Patient.id).filter(Patient.customer_id.in_(customers))
+    return db.union(by_name, by_customer)
+
+
+# search patients
+@patients_bp.route('/search')
+@jwt_required()
+def search_patients():
+    '''Return one page of the patients the current user can access which match the search, ordered by id. The query string arguments are q for the words to search, species, sex and customer_email for filtering, and limit and after for paging, and are all optional. Each word of q must match the start of the name of the patient or of the first name, last name or email of its customer, or be similar to one of them to allow for typos. customer_email matches the start of the email of the customer. The format of the values are: string for q and customer_email, dog, cat, bird, fish or rabbit for species, Female or Male for sex, and integer for limit and after. The Link header contains the URL of the next page, if any.'''
+    stmt = db.select(Patient).join(Customer, Customer.id==Patient.customer_id).filter(access.patient_access()).options(
+        contains_eager(Patient.customer), selectinload(Patient.appointments).joinedload(Appointment.veterinarian)
+    )
+    for word in request.args.get('q', '').split():
+        stmt = stmt.filter(Patient.id.in_(matching_patient_ids(word)))
+    species = request.args.get('species')
+    sex = request.args.get('sex')
+    customer_email = request.args.get('customer_email')
+    if species:
+        stmt = stmt.filter(Patient.species == species)
+    if sex:
+        stmt = stmt.filter(Patient.sex == sex)
+    if customer_email:
+        stmt = stmt.filter(prefix_condition(Customer.email, customer_email))
+    patients, headers = gb.paginate(stmt, Patient)
+    return gb.dump(PatientSchema, patients, many=True), 200, headers
+
+
 # read one patient
 @patients_bp.route('/<int:patient_id>/')
-@auto.doc()
 @jwt_required()
 def get_one_patient(patient_id):
     '''Return one patient with the given id in the format of integer as argument.'''
-    patient = gb.required_record(Patient, patient_id)
-    if gb.is_admin() or is_patient_authorized_person(patient_id):
+    patient, authorized = gb.authorized_record(Patient, patient_id, access.patient_access(), *patient_loading_plan)
+    if authorized:
         # get one record from the patients table in the database with the given patient id
-        return PatientSchema().dump(patient)
+        return gb.dump(PatientSchema, patient)
     else:
         return {'error': 'You are not authorized to view the information.'}, 401
 
 
 # read current user's patients
 @patients_bp.route('/my_patients/')
-@auto.doc()
 @jwt_required()
 def my_patients():
     '''Return all the patients for the current user.'''
-    if get_jwt()['role'] == 'veterinarian':
+    if identity.is_veterinarian():
+        # get the patients which have appointments with the current veterinarian, each patient once
         veterinarian_id = current_user.id
-        stmt = db.select(Patient). join(Appointment, Patient.id==Appointment.patient_id).filter_by(veterinarian_id=veterinarian_id)
+        patient_ids = db.select(Appointment.patient_id).filter_by(veterinarian_id=veterinarian_id)
+        stmt = db.select(Patient).filter(Patient.id.in_(patient_ids)).options(*patient_loading_plan)
         result = db.session.scalars(stmt)
-        return PatientSchema(many=True).dump(result)
+        return gb.dump(PatientSchema, result, many=True)
     else:
-        return PatientSchema(many=True, exclude=['customer', 'customer_id']).dump(current_user.patients)
+        stmt = db.select(Patient).filter_by(customer_id=current_user.id).options(*patient_without_customer_loading_plan)
+        return gb.dump(PatientSchema, db.session.scalars(stmt), many=True, exclude=['customer', 'customer_id'])
 
 
 # delete one patient
 @patients_bp.route('/<int:patient_id>/', methods=['DELETE'])
-@auto.doc()
 @jwt_required()
 def delete_patient(patient_id):
     '''Admin Interface - Delete one patient with the given id in the format of integer as argument.'''
     patient = gb.required_record(Patient, patient_id)
-    if gb.is_admin():
+    if identity.is_admin():
         # delete one record from the patients table in the database with the given patient id
         db.session.delete(patient)
         db.session.commit()
@@ -100,24 +142,22 @@ def delete_patient(patient_id):
 
 # update one patient
 @patients_bp.route('/<int:patient_id>/', methods=['PUT', 'PATCH'])
-@auto.doc()
 @jwt_required()
 def update_patient(patient_id):
     '''Update one patient with the given id in the format of integer as argument and the key-value pairs as request body, and return the updated patient. The keys are name, sex, age, weight, species and customer_id, and are all optional. The format of values are: non-empty string for name with the maximum length of 25 characters, positive integer for age, numeric between 0.01 and 99.99 for weight, Female or Male for sex, dog, cat, bird, fish or rabbit for species, and integer for customer_id.'''
-    patient = gb.required_record(Patient, patient_id)
-    if gb.is_admin() or is_patient_authorized_person(patient_id):
+    patient, authorized = gb.authorized_record(Patient, patient_id, access.patient_access(), *patient_loading_plan)
+    if authorized:
         # update one record in the patients table in the database with the given patient id using the information contained in the request
         for key in list(request.json.keys()-['patient']):
             setattr(patient, key, gb.required_value_converter(patient, key))
         db.session.commit()
-        return PatientSchema().dump(patient)
+        return gb.dump(PatientSchema, patient)
     else:
         return {'error': 'You are not authorized to update the information.'}, 401
 
 
 # create a new patient
 @patients_bp.route('/register/', methods=['POST'])
-@auto.doc()
 @jwt_required()
 def patient_register():
     '''Patient registration in the format of integer as argument and the key-value pairs as request body, and return the created patient. The keys are name, sex, age, weight, species and customer_id, and are all required. The format of values are: non-empty string for name with the maximum length of 25 characters, positive integer for age, numeric between 0.01 and 99.99 for weight, Female or Male for sex, dog, cat, bird, fish or rabbit for species, and integer for customer_id.'''
@@ -132,4 +172,4 @@ def patient_register():
     )
     db.session.add(patient)
     db.session.commit()
-    return PatientSchema().dump(patient), 201
+    return gb.dump(PatientSchema, patient), 201
@@ -1,15 +1,33 @@
 from types import NoneType
-from flask import Blueprint, request
-from init import db, bcrypt, jwt, auto
+from flask import Blueprint, request, current_app
+from init import db, hasher
 from flask_jwt_extended import jwt_required, create_access_token, current_user, get_jwt
 from models.veterinarian import VeterinarianSchema, Veterinarian
-from models.token_block_list import TokenBlocklist
+from models.appointment import Appointment
+from models.slot_hold import SlotHold
+from revocation import revocation
+from routing import use_primary, primary
+from instrumentation import timed
+from cache import LRUCache
 import gb
+import identity
 from datetime import timedelta, datetime
+from sqlalchemy.orm import selectinload
 
 
 veterinarians_bp = Blueprint('veterinarians', __name__, url_prefix='/veterinarians')
 
+# the relationship serialized by VeterinarianSchema, loaded together with the veterinarians to avoid one query per veterinarian
+veterinarian_loading_plan = [selectinload(Veterinarian.appointments)]
+
+# the columns of the public information of the veterinarians
+public_columns = [Veterinarian.id, Veterinarian.first_name, Veterinarian.last_name, Veterinarian.description, Veterinarian.email, Veterinarian.sex, Veterinarian.languages]
+
+# the rendered public information of the veterinarians, cleared whenever a veterinarian is created, updated or deleted in this process
+# the entries also expire after PUBLIC_CACHE_SECONDS (5 by default), which bounds how long the other workers can serve stale information,
+# while the cache still answers the bursts of requests for the lists from memory
+# they are built from the primary, as a payload read from a lagging replica would be cached for that long
+public_cache = LRUCache(max_size=1024)
 
 # check if the veterinarian who has logged in has been authorized
 def is_authorized_veterinarian(veterinarian_id):
@@ -33,96 +51,139 @@ def nullable_value_converter(self, key):
         return if_empty_convert_to_null(value)
 
 
-@jwt.token_in_blocklist_loader
-def check_if_token_revoked(jwt_header, jwt_payload):
-    jti = jwt_payload["jti"]
-    stmt = db.select(TokenBlocklist).filter_by(jti=jti)
-    token = db.session.scalar(stmt)
-    return token is not None
-
-
-@jwt.revoked_token_loader
-def revoked_token(jwt_header, jwt_payload):
-    return {'error': "You haven't logged into the app yet."}, 401
+# serialize one row of the public columns as VeterinarianSchema(only=[...]) would, i.e. with the enums by name
+def dump_public_row(row):
+    return {
+        'id': row.id,
+        'first_name': row.first_name,
+        'last_name': row.last_name,
+        'description': row.description,
+        'email': row.email,
+        'sex': row.sex.name if row.sex is not None else None,
+        'languages': [language.name for language in row.languages] if row.languages is not None else None
+    }
 
 
-@jwt.user_lookup_loader
-def user_lookup_callback(_jwt_header, jwt_data):
-    identity = jwt_data["sub"]
-    return Veterinarian.query.filter_by(id=identity).one_or_none()
+# select the public columns only and build the same output as VeterinarianSchema without loading the models
+def dump_all_public_rows():
+    with primary():
+        rows = db.session.execute(db.select(*public_columns)).all()
+    with timed('serialize'):
+        return [dump_public_row(row) for row in rows]
 
 
 # read all veterinarians and return the public information only
 @veterinarians_bp.route('/public/')
-@auto.doc()
 def get_all_veterinarians():
-    '''Return the public information of all veterinarians.'''
-    # get all records from the veterinarians table in the database
-    veterinarians = gb.filter_all_records(Veterinarian)
-    return VeterinarianSchema(many=True, only=['id', 'first_name', 'last_name', 'description', 'email', 'sex', 'languages']).dump(veterinarians)
+    '''Return the public information of all veterinarians. The information is cached, so a change made through another server process can take up to PUBLIC_CACHE_SECONDS (5 seconds by default) to be returned.'''
+    return gb.cached_response(public_cache, 'all', dump_all_public_rows, current_app.config['PUBLIC_CACHE_SECONDS'])
 
 
 # read all veterinarians and return all information, except password
 @veterinarians_bp.route('/')
-@auto.doc()
 @jwt_required()
 def get_all_veterinarians_full_details():
-    '''Admin interface - Return the full details of all veterinarians including is_admin and appointments.'''
-    if gb.is_admin():
-        # get all records from the veterinarians table in the database
-        veterinarians = gb.filter_all_records(Veterinarian)
-        return VeterinarianSchema(many=True).dump(veterinarians)
+    '''Admin interface - Return the full details of one page of veterinarians including is_admin and appointments, ordered by id. The query string arguments are limit and after for paging, and sex and language for filtering, and are all optional. The format of the values are: integer for limit and after, Female or Male for sex, and one of Mandarin, Cantonese, Korean, Japanese, Spanish or French for language. The Link header contains the URL of the next page, if any.'''
+    if identity.is_admin():
+        # get one page of the records from the veterinarians table in the database which match the filters
+        stmt = db.select(Veterinarian).options(*veterinarian_loading_plan)
+        sex = request.args.get('sex')
+        language = request.args.get('language')
+        if sex:
+            stmt = stmt.filter(Veterinarian.sex == sex)
+        if language:
+            stmt = stmt.filter(Veterinarian.languages.any(language))
+        veterinarians, headers = gb.paginate(stmt, Veterinarian)
+        return gb.dump(VeterinarianSchema, veterinarians, many=True), 200, headers
     else:
         return {'error': 'You are not an administrator.'}, 401
 
 
 # read one veterinarian and return the public information only
 @veterinarians_bp.route('/<int:veterinarian_id>/public')
-@auto.doc()
 def get_one_veterinarian(veterinarian_id):
-    '''Return the public information of one veterinarian with the given id in the format of integer as argument.'''
-    # get one record from the veterinarians table in the database with the given veterinarian id
-    veterinarian = gb.required_record(Veterinarian, veterinarian_id)
-    return VeterinarianSchema(only=['first_name', 'last_name', 'description', 'email', 'sex', 'languages']).dump(veterinarian)
+    '''Return the public information of one veterinarian with the given id in the format of integer as argument. The information is cached as for all veterinarians.'''
+    # get one record from the veterinarians table in the database with the given veterinarian id, unless it is cached
+    def dump_public_veterinarian():
+        with primary():
+            veterinarian = gb.required_record(Veterinarian, veterinarian_id)
+        return gb.dump(VeterinarianSchema, veterinarian, only=['first_name', 'last_name', 'description', 'email', 'sex', 'languages'])
+    return gb.cached_response(public_cache, veterinarian_id, dump_public_veterinarian, current_app.config['PUBLIC_CACHE_SECONDS'])
+
+
+# read the free appointment slots of one veterinarian
+@veterinarians_bp.route('/<int:veterinarian_id>/availability')
+@jwt_required()
+@use_primary
+def get_veterinarian_availability(veterinarian_id):
+    '''Return the free appointment slots of one veterinarian with the given id in the format of integer as argument, grouped by date. The query string arguments are from and to in the format of yyyy-mm-dd, and are both optional. The default value is tomorrow for from, and the value of from for to. Dates before tomorrow are skipped as booking has to be made one day in advance, the slots held by someone are not free until their holds expire, and dates without free slots are left out.'''
+    gb.required_record(Veterinarian, veterinarian_id)
+    tomorrow = datetime.today().date() + timedelta(days=1)
+    date_from = max(gb.date_argument('from', tomorrow), tomorrow)
+    date_to = gb.date_argument('to', date_from)
+    if date_to < date_from:
+        return {'error': 'Invalid date range.'}, 403
+    if (date_to - date_from).days >= current_app.config['AVAILABILITY_MAX_DAYS']:
+        return {'error': f"The date range must not exceed {current_app.config['AVAILABILITY_MAX_DAYS']} days."}, 403
+    opening, closing = gb.clinic_hours()
+    step = timedelta(minutes=gb.SLOT_MINUTES)
+    last_time = (datetime.combine(date_from, closing) - step).time()
+    # generate every slot in the date range and keep those within the clinic hours which are not booked with or held for the veterinarian, all in one query
+    slot = db.func.generate_series(datetime.combine(date_from, opening), datetime.combine(date_to, last_time), step, type_=db.DateTime).column_valued('slot')
+    booked = db.select(Appointment.id).filter(
+        Appointment.veterinarian_id == veterinarian_id,
+        Appointment.date == db.cast(slot, db.Date),
+        Appointment.time == db.cast(slot, db.Time)
+    )
+    # the slots held by someone are not free either, as booking them is turned away until the holds expire
+    held = db.select(SlotHold.id).filter(
+        SlotHold.veterinarian_id == veterinarian_id,
+        SlotHold.date == db.cast(slot, db.Date),
+        SlotHold.time == db.cast(slot, db.Time),
+        SlotHold.expires_at > datetime.now()
+    )
+    stmt = db.select(slot).filter(db.cast(slot, db.Time).between(opening, last_time), ~booked.exists(), ~held.exists()).order_by(slot)
+    availability = {}
+    for free_slot in db.session.scalars(stmt):
+        availability.setdefault(free_slot.date().isoformat(), []).append(free_slot.strftime('%H:%M'))
+    return {'veterinarian_id': veterinarian_id, 'from': date_from.isoformat(), 'to': date_to.isoformat(), 'slots': availability}
 
 
 # read current veterinarian's profile
 @veterinarians_bp.route('/my_profile/')
-@auto.doc()
 @jwt_required()
 def my_profile():
     '''Return the profile of the current veterinarian including is_admin.'''
-    if get_jwt()['role'] == 'veterinarian':
-        return VeterinarianSchema(exclude=['appointments']).dump(current_user)
+    if identity.is_veterinarian():
+        return gb.dump(VeterinarianSchema, current_user, exclude=['appointments'])
     else:
         return {'error': 'You are not a veterinarian'}, 401
 
 
 # read one veterinarian and return all information, except password
 @veterinarians_bp.route('/<int:veterinarian_id>/')
-@auto.doc()
 @jwt_required()
 def get_one_veterinarian_full_details(veterinarian_id):
     '''Return the full details of one veterinarian with the given id in the format of integer as argument.'''
     # get one record from the veterinarians table in the database with the given veterinarian id
-    veterinarian = gb.required_record(Veterinarian, veterinarian_id)
-    if gb.is_admin() or is_authorized_veterinarian(veterinarian_id):
-        return VeterinarianSchema().dump(veterinarian)
+    veterinarian = gb.required_record(Veterinarian, veterinarian_id, *veterinarian_loading_plan)
+    if identity.is_admin() or is_authorized_veterinarian(veterinarian_id):
+        return gb.dump(VeterinarianSchema, veterinarian)
     else:
         return {'error': 'You are not authorized to view the information.'}, 401
 
 
 # delete one veterinarian
 @veterinarians_bp.route('/<int:veterinarian_id>/', methods=['DELETE'])
-@auto.doc()
 @jwt_required()
 def delete_veterinarian(veterinarian_id):
     '''Admin interface - Delete one veterinarian with the given id in the format of integer as argument.'''
     veterinarian = gb.required_record(Veterinarian, veterinarian_id)
-    if gb.is_admin():
+    if identity.is_admin():
         # delete one record from the veterinarians table in the database with the given veterinarian id
         db.session.delete(veterinarian)
         db.session.commit()
+        public_cache.clear()
         return {'msg': f'Veterinarian {veterinarian.first_name} {veterinarian.last_name} deleted successfully'}
     else:
         return {'error': 'You are not an administrator.'}, 401
@@ -130,12 +191,11 @@ def delete_veterinarian(veterinarian_id):
 
 # update one veterinarian
 @veterinarians_bp.route('/<int:veterinarian_id>/', methods=['PUT', 'PATCH'])
-@auto.doc()
 @jwt_required()
 def update_veterinarian(veterinarian_id):
     '''Update one veterinarian with the given id in the format of integer as argument and the key-value pairs as request body, and return the updated profile of the veterinarian excluding appointments. The keys are first_name, last_name, email, password, sex, is_admin, description and languages, and are all optional. The format of the values are: non-empty string for first_name and last_name with the maximum length of 25 characters, string for email with the maximum length of 50 characters, string for password with the mininum length of 8 characters and containing at lease one letter, one number and one special character, text for description, Female or Male for sex, true or false for is_admin, and array with Mandarin, Cantonese, Korean, Japanese, Spanish, and/or French for languages.'''
     veterinarian = gb.required_record(Veterinarian, veterinarian_id)
-    if gb.is_admin() or is_authorized_veterinarian(veterinarian_id):
+    if identity.is_admin() or is_authorized_veterinarian(veterinarian_id):
         # update one record in the veterinarians table in the database with the given veterinarian id using the information contained in the request
         for key in list(request.json.keys()):
             if key in ['languages', 'description']:
@@ -143,14 +203,14 @@ def update_veterinarian(veterinarian_id):
             else:
                 setattr(veterinarian, key, gb.required_value_converter(veterinarian, key))
         db.session.commit()
-        return VeterinarianSchema(exclude=['appointments']).dump(veterinarian)
+        public_cache.clear()
+        return gb.dump(VeterinarianSchema, veterinarian, exclude=['appointments'])
     else:
         return {'error': 'You are not authorized to update the information.'}, 401
 
 
 # create a new veterinarian
 @veterinarians_bp.route('/register/', methods=['POST'])
-@auto.doc()
 def veterinarian_register():
     '''Create a new veterinarian with the key-value pairs as request body, and return the full details of the veterinarian created. The keys are first_name, last_name, email, password, sex, is_admin, description and languages, and are all required, except description and languages. The format of the values are: non-empty string for first_name and last_name with the maximum length of 25 characters, string for email with the maximum length of 50 characters, string for password with the mininum length of 8 characters and containing at lease one letter, one number and one special character, text for description, Female or Male for sex, true or false for is_admin, and array with Mandarin, Cantonese, Korean, Japanese, Spanish, and/or French for languages. The default value is false for is_admin.'''
     password_input = request.json['password']
@@ -163,7 +223,7 @@ def veterinarian_register():
         first_name = request.json['first_name'],
         last_name = request.json['last_name'],
         email = request.json['email'],
-        password = bcrypt.generate_password_hash(password_input).decode('utf-8'),
+        password = hasher.hash(password_input),
         sex = request.json['sex'],
         languages = if_empty_convert_to_null(request.json.get('languages')),
         is_admin = is_admin_input,
@@ -171,23 +231,23 @@ def veterinarian_register():
     )
     db.session.add(veterinarian)
     db.session.commit()
-    return VeterinarianSchema().dump(veterinarian), 201
+    public_cache.clear()
+    return gb.dump(VeterinarianSchema, veterinarian), 201
 
 
 # veterinarian authentication
 @veterinarians_bp.route('/login/', methods=['POST'])
-@auto.doc()
 def veterinarian_login():
     '''Veterinarian login with the key-value pairs for email and password as request body and return the email of and token for the veterinarian.'''
     email=request.json['email']
     password = request.json['password']
     # get one record from the veterinarians table in the database with the given email
     veterinarian = gb.filter_one_record_by_email(Veterinarian, email)
-    if veterinarian and bcrypt.check_password_hash(veterinarian.password, password):
+    if veterinarian and gb.check_password(veterinarian, password):
         # identity = ''.join(['V', str(veterinarian.id)])
-        identity = str(veterinarian.id)
         additional_claims = {'role': 'veterinarian'}
-        token = create_access_token(identity=identity, expires_delta=timedelta(days=1), additional_claims=additional_claims)
+        token = create_access_token(identity=str(veterinarian.id), expires_delta=timedelta(days=1), additional_claims=additional_claims)
+        identity.logged_in('veterinarian', veterinarian.id)
         return {'email': veterinarian.email, 'token': token}
     else:
         return {'error': 'Invalid email or passord'}, 401
@@ -195,12 +255,9 @@ def veterinarian_login():
 
 # JWT revoking
 @veterinarians_bp.route("/logout/", methods=["DELETE"])
-@auto.doc()
 @jwt_required()
 def revoke_token():
     '''Veterinarian logout.'''
-    jti = get_jwt()["jti"]
-    now = datetime.now()
-    db.session.add(TokenBlocklist(jti=jti, created_at=now))
-    db.session.commit()
+    jwt_data = get_jwt()
+    revocation.revoke(jwt_data['jti'], datetime.fromtimestamp(jwt_data['exp']))
     return {'msg': 'You logged out successfully'}
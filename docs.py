@@ -0,0 +1,149 @@
+import html
+import re
+from marshmallow import fields
+from marshmallow_enum import EnumField
+from sqlalchemy import types
+from models.customer import Customer, CustomerSchema
+from models.patient import Patient, PatientSchema
+from models.veterinarian import Veterinarian, VeterinarianSchema
+from models.appointment import Appointment, AppointmentSchema
+
+# Build the OpenAPI 3 document of the API from the routes registered in the app, the docstrings of their views and the schemas of the models.
+# The document and the documentation page only change with the code, so each process builds them once (see controllers/docs_controller.py).
+
+# the schemas documented as components, with the models their inferred fields are read from
+SCHEMAS = {
+    'Customer': (CustomerSchema, Customer),
+    'Patient': (PatientSchema, Patient),
+    'Veterinarian': (VeterinarianSchema, Veterinarian),
+    'Appointment': (AppointmentSchema, Appointment)
+}
+
+# the endpoints which are not part of the API
+EXCLUDED_ENDPOINTS = ['static', 'docs.documentation', 'docs.openapi']
+
+# the arguments of a URL rule with their converters, e.g. <int:customer_id>
+RULE_ARGUMENT = re.compile(r'<(?:(\w+)(?:\([^)]*\))?:)?(\w+)>')
+
+# the methods Flask adds to every route
+IMPLICIT_METHODS = ['HEAD', 'OPTIONS']
+
+# the JSON schemas of the column types, in the format the app dumps them
+COLUMN_TYPES = [
+    (types.Boolean, {'type': 'boolean'}),
+    (types.Integer, {'type': 'integer'}),
+    (types.Numeric, {'type': 'string', 'format': 'decimal'}),
+    (types.DateTime, {'type': 'string', 'format': 'date-time'}),
+    (types.Date, {'type': 'string', 'format': 'date'}),
+    (types.Time, {'type': 'string', 'format': 'time'}),
+    (types.String, {'type': 'string'})
+]
+
+
+# get the JSON schema of a column type
+def column_schema(column_type):
+    if isinstance(column_type, types.ARRAY):
+        return {'type': 'array', 'items': column_schema(column_type.item_type)}
+    elif isinstance(column_type, types.Enum):
+        return {'type': 'string', 'enum': list(column_type.enums)}
+    for type_class, schema in COLUMN_TYPES:
+        if isinstance(column_type, type_class):
+            return dict(schema)
+    return {}
+
+
+# get the JSON schema of a field of the schema of the model
+# the fields listed in Meta.fields without a declaration are inferred by marshmallow, so their types are read from the columns of the model
+def field_schema(name, field, model):
+    if isinstance(field, fields.List):
+        return {'type': 'array', 'items': field_schema(name, field.inner, model)}
+    elif isinstance(field, fields.Nested):
+        nested = field.nested if isinstance(field.nested, str) else field.nested.__name__
+        return {'$ref': f"#/components/schemas/{nested.removesuffix('Schema')}"}
+    elif isinstance(field, EnumField):
+        return {'type': 'string', 'enum': [member.name for member in field.enum]}
+    column = model.__table__.columns.get(name)
+    return column_schema(column.type) if column is not None else {'type': 'string'}
+
+
+# get the JSON schema of the schema of the model
+def component_schema(schema_class, model):
+    schema = schema_class()
+    return {'type': 'object', 'properties': {name: field_schema(name, field, model) for name, field in schema.fields.items()}}
+
+
+# check if the view requires a token, i.e. if it is wrapped by jwt_required
+def requires_token(view):
+    while view is not None:
+        if 'verify_jwt_in_request' in view.__code__.co_names:
+            return True
+        view = getattr(view, '__wrapped__', None)
+    return False
+
+
+# get the operation of one method of the route
+def operation(rule, method, view):
+    docstring = (view.__doc__ or '').strip()
+    summary = docstring.split('. ')[0].rstrip('.') if docstring else rule.endpoint
+    parameters = [
+        {'name': name, 'in': 'path', 'required': True, 'schema': {'type': 'integer' if converter == 'int' else 'string'}}
+        for converter, name in RULE_ARGUMENT.findall(rule.rule)
+    ]
+    result = {
+        'operationId': f"{rule.endpoint}.{method.lower()}" if len(rule.methods - set(IMPLICIT_METHODS)) > 1 else rule.endpoint,
+        'tags': [rule.endpoint.split('.')[0]],
+        'summary': summary,
+        'description': docstring,
+        'parameters': parameters,
+        'responses': {'200': {'description': 'Success'}}
+    }
+    if method in ['POST', 'PUT', 'PATCH']:
+        result['requestBody'] = {'content': {'application/json': {'schema': {'type': 'object'}}}}
+    if requires_token(view):
+        result['security'] = [{'bearerAuth': []}]
+        result['responses']['401'] = {'description': 'The token is missing or invalid, or the user is not authorized'}
+    return result
+
+
+# build the OpenAPI document of the app
+def build_spec(app):
+    paths = {}
+    for rule in sorted(app.url_map.iter_rules(), key=lambda rule: rule.rule):
+        if rule.endpoint in EXCLUDED_ENDPOINTS:
+            continue
+        path = RULE_ARGUMENT.sub(r'{\2}', rule.rule)
+        view = app.view_functions[rule.endpoint]
+        for method in sorted(rule.methods - set(IMPLICIT_METHODS)):
+            paths.setdefault(path, {})[method.lower()] = operation(rule, method, view)
+    return {
+        'openapi': '3.0.3',
+        'info': {'title': 'Vet clinic API', 'version': '1.0.0', 'description': 'Book and manage the appointments of a vet clinic.'},
+        'paths': paths,
+        'components': {
+            'schemas': {name: component_schema(schema_class, model) for name, (schema_class, model) in SCHEMAS.items()},
+            'securitySchemes': {'bearerAuth': {'type': 'http', 'scheme': 'bearer', 'bearerFormat': 'JWT'}}
+        }
+    }
+
+
+# build the documentation page of the OpenAPI document, i.e. one table of the operations for each tag
+def build_html(spec):
+    tags = {}
+    for path, methods in spec['paths'].items():
+        for method, details in methods.items():
+            tags.setdefault(details['tags'][0], []).append((path, method, details))
+    sections = []
+    for tag, operations in tags.items():
+        rows = ''.join(
+            f"<tr><td><code>{method.upper()}</code></td><td><code>{html.escape(path)}</code></td>"
+            f"<td>{'Token' if 'security' in details else 'Public'}</td><td>{html.escape(details['description'])}</td></tr>"
+            for path, method, details in operations
+        )
+        sections.append(f'<h2>{html.escape(tag)}</h2><table><tr><th>Method</th><th>Path</th><th>Access</th><th>Description</th></tr>{rows}</table>')
+    title = html.escape(spec['info']['title'])
+    return (
+        f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>{title}</title>'
+        '<style>body{font-family:sans-serif;margin:2em}table{border-collapse:collapse;width:100%}td,th{border:1px solid #ccc;padding:4px 8px;text-align:left;vertical-align:top}</style>'
+        f'</head><body><h1>{title}</h1><p>The OpenAPI document is available at <a href="/documentation/openapi.json">/documentation/openapi.json</a>.</p>'
+        f"{''.join(sections)}</body></html>"
+    )
@@ -1,19 +1,65 @@
-from init import db, bcrypt
+from init import db, hasher
+from instrumentation import timed
 import re
 from sqlalchemy.exc import NoResultFound
-from flask import request
+from flask import request, current_app, url_for, Response, stream_with_context
 from types import NoneType
+from datetime import datetime, date, time
+from decimal import Decimal
+import csv, enum, hashlib, io, json
 from flask_jwt_extended import get_jwt_identity, get_jwt
-from models.veterinarian import Veterinarian
+
+# the media types of the formats supported by the export endpoints
+EXPORT_MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+# the schema instances built so far, one for each combination of schema class, many, only and exclude
+schema_instances = {}
+
+# length of one appointment slot in minutes, i.e. the 00, 15, 30 and 45 minutes grid enforced by Appointment.validate_time
+SLOT_MINUTES = 15
+
+# get the schema instance with the given options, building it only the first time it is required
+def schema(schema_class, many=False, only=None, exclude=()):
+    key = (schema_class, many, tuple(only) if only is not None else None, tuple(exclude))
+    instance = schema_instances.get(key)
+    if instance is None:
+        instance = schema_instances[key] = schema_class(many=many, only=only, exclude=exclude)
+    return instance
+
+# serialize the records with the schema instance of the given options, timed as the serialize section of the request
+def dump(schema_class, records, many=False, only=None, exclude=()):
+    with timed('serialize'):
+        return schema(schema_class, many, only, exclude).dump(records)
+
+# return the JSON payload built by build() as a response with a strong ETag, which clients can revalidate with If-None-Match
+# the body and the ETag are kept in the cache under the key, so a cached payload is answered (or 304 Not Modified) without building it again
+# a payload which depends on the user must not be public, so that shared caches (e.g. the CDN) do not keep it
+# with a mimetype (e.g. text/html), build() returns the text of the body rather than a JSON payload
+def cached_response(cache, key, build, ttl=None, public=True, mimetype=None):
+    entry = cache.get(key)
+    if entry is None:
+        body = build().encode('utf-8') if mimetype else current_app.json.response(build()).get_data()
+        entry = (body, hashlib.sha256(body).hexdigest())
+        cache.set(key, entry, ttl)
+    body, etag = entry
+    response = current_app.response_class(body, mimetype=mimetype or current_app.json.mimetype)
+    response.set_etag(etag)
+    if public:
+        response.cache_control.public = True
+    else:
+        response.cache_control.private = True
+    response.cache_control.max_age = 0
+    response.cache_control.must_revalidate = True
+    return response.make_conditional(request)
 
 # get all records from the given table in the database
 def filter_all_records(model):
     stmt = db.select(model)
     return db.session.scalars(stmt)
 
-# get one record from the given table in the database with the given id
-def filter_one_record_by_id(model, id):
-    stmt = db.select(model).filter_by(id=id)
+# get one record from the given table in the database with the given id, loading the relationships with the given loader options
+def filter_one_record_by_id(model, id, *options):
+    stmt = db.select(model).filter_by(id=id).options(*options)
     return db.session.scalar(stmt)
 
 # get one record from the given table in the database with the given email
@@ -29,12 +75,30 @@ def validate_password(password):
     return True
 
 # check if the required id exists in the given table in the database
-def required_record(model, id):
-    record = filter_one_record_by_id(model, id)
+def required_record(model, id, *options):
+    record = filter_one_record_by_id(model, id, *options)
     if not record:
         raise NoResultFound(f'{model.__name__} with id {id} not found')
     return record
 
+# get the required record together with whether the current user can access it according to the access condition (see access.py), in one query
+# raise NoResultFound if the record does not exist, and return the record and True or False otherwise
+def authorized_record(model, id, access, *options):
+    stmt = db.select(model, access.label('authorized')).filter_by(id=id).options(*options)
+    row = db.session.execute(stmt).first()
+    if not row:
+        raise NoResultFound(f'{model.__name__} with id {id} not found')
+    return row[0], bool(row.authorized)
+
+# check the password of the customer or veterinarian, and rehash it if it was hashed with a work factor other than the configured one
+def check_password(user, password):
+    if not hasher.check(user.password, password):
+        return False
+    if hasher.needs_rehash(user.password):
+        user.password = hasher.hash(password)
+        db.session.commit()
+    return True
+
 # return a correct value according to the data in the request
 def required_value_converter(self, key):
     value = request.json.get(key)
@@ -43,7 +107,7 @@ def required_value_converter(self, key):
     else:
         if key == 'password':
             validate_password(value)
-            return bcrypt.generate_password_hash(value).decode('utf-8')
+            return hasher.hash(value)
         else:
             return value
 
@@ -59,10 +123,100 @@ def get_veterinarian_id():
         return False
     return int(get_jwt_identity())
 
-# check if the person is an administrator according to the identity contained in the token
-def is_admin():
-    id = get_veterinarian_id()
-    if id:
-        veterinarian = filter_one_record_by_id(Veterinarian, id)
-        if veterinarian.is_admin:
-            return True
\ No newline at end of file
+# get the value of the given query string argument as an integer, or the default value if the argument is not provided
+def int_argument(key, default=None):
+    value = request.args.get(key)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f'Invalid {key} - It must be an integer')
+
+# get the value of the given query string argument as a date, or the default value if the argument is not provided
+def date_argument(key, default=None):
+    value = request.args.get(key)
+    if not value:
+        return default
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError(f'Invalid {key} - The format must be yyyy-mm-dd')
+
+# convert the time of a booking in the format of hh:mm, or hh:mm:ss as the times are dumped, to a time
+def time_value(value):
+    for time_format in ['%H:%M', '%H:%M:%S']:
+        try:
+            return datetime.strptime(value, time_format).time()
+        except ValueError:
+            pass
+    raise ValueError('Invalid time - The format must be hh:mm')
+
+# get the opening and closing time of the clinic from the configuration
+def clinic_hours():
+    opening = datetime.strptime(current_app.config['CLINIC_OPENING_TIME'], '%H:%M').time()
+    closing = datetime.strptime(current_app.config['CLINIC_CLOSING_TIME'], '%H:%M').time()
+    if opening.minute % SLOT_MINUTES or closing.minute % SLOT_MINUTES or opening >= closing:
+        raise ValueError('Invalid clinic hours')
+    return opening, closing
+
+
+# get one page of the records selected by the statement using keyset pagination, i.e. ordered by id and starting after the id given as the after argument
+# the headers link to the next page, so the client can page through a large table without the server loading all of it
+def paginate(stmt, model):
+    limit = int_argument('limit', current_app.config['PAGE_SIZE'])
+    if limit < 1 or limit > current_app.config['MAX_PAGE_SIZE']:
+        raise ValueError(f"Invalid limit - It must be between 1 and {current_app.config['MAX_PAGE_SIZE']}")
+    after = int_argument('after')
+    if after is not None:
+        stmt = stmt.filter(model.id > after)
+    # fetch one more record than the limit to know if there is a next page
+    records = db.session.scalars(stmt.order_by(model.id).limit(limit + 1)).all()
+    headers = {}
+    if len(records) > limit:
+        records = records[:limit]
+        cursor = records[-1].id
+        args = {**request.view_args, **request.args.to_dict(), 'after': cursor}
+        headers['Link'] = f'<{url_for(request.endpoint, **args)}>; rel="next"'
+        headers['X-Next-Cursor'] = str(cursor)
+    return records, headers
+
+
+# convert a value read from the database to the same JSON value as the schemas and the app produce
+def export_value(value):
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    elif isinstance(value, Decimal):
+        return str(value)
+    elif isinstance(value, enum.Enum):
+        return value.name
+    return value
+
+# stream the rows selected by the statement as NDJSON or CSV according to the format argument
+# the rows are read in batches of EXPORT_BATCH_SIZE through a server-side cursor, and each batch is sent as soon as it is read
+def export_response(stmt, filename):
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_MIMETYPES:
+        raise ValueError('Invalid format - The format must be ndjson or csv')
+
+    def generate():
+        result = db.session.execute(stmt.execution_options(stream_results=True, yield_per=current_app.config['EXPORT_BATCH_SIZE']))
+        columns = list(result.keys())
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if export_format == 'csv':
+            writer.writerow(columns)
+            yield buffer.getvalue()
+        for rows in result.partitions():
+            buffer.seek(0)
+            buffer.truncate()
+            for row in rows:
+                values = [export_value(value) for value in row]
+                if export_format == 'csv':
+                    writer.writerow(values)
+                else:
+                    buffer.write(json.dumps(dict(zip(columns, values))) + '\n')
+            yield buffer.getvalue()
+
+    headers = {'Content-Disposition': f'attachment; filename={filename}.{export_format}'}
+    return Response(stream_with_context(generate()), mimetype=EXPORT_MIMETYPES[export_format], headers=headers)
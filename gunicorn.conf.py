@@ -0,0 +1,19 @@
+import multiprocessing
+import os
+
+# The gunicorn configuration of the app in production, used with `gunicorn -c gunicorn.conf.py wsgi:app`.
+# The settings can be overridden with the environment variables below, or on the command line.
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+# load and warm up the app once in the master process before the workers are forked (see wsgi.py)
+preload_app = True
+
+
+# each worker must open its own database connections rather than use those inherited from the master
+def post_fork(server, worker):
+    from app import dispose_engines
+    from wsgi import app
+    dispose_engines(app)
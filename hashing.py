@@ -0,0 +1,103 @@
+import multiprocessing
+import os
+import threading
+import time
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+import bcrypt
+from werkzeug.exceptions import ServiceUnavailable
+
+
+# hash the password with the given work factor (run in a worker process)
+def hash_password(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+# check the password against the hash (run in a worker process)
+def check_password(hashed, password):
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+# get the work factor of the hash, e.g. 12 for $2b$12$...
+def hash_rounds(hashed):
+    return int(hashed.split('$')[2])
+
+
+# Run bcrypt in a bounded pool of worker processes instead of on the request threads.
+# At most BCRYPT_QUEUE_LIMIT hashes can be running or waiting in each app process. Beyond that the request fails fast with a 503.
+# The pool is created lazily in each process, so a pool created before a fork is never shared with the child.
+# With BCRYPT_POOL_SIZE set to 0, the hashes are computed inline.
+# on_complete, if set, is called with 'bcrypt' and the duration in seconds after each hash or check.
+class PasswordHasher:
+    def __init__(self):
+        self.rounds = 12
+        self.pool_size = os.cpu_count() or 1
+        self.queue_limit = self.pool_size * 4
+        self.timeout = 10
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._slots = None
+        self.on_complete = None
+
+    def init_app(self, app):
+        self.rounds = app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        self.pool_size = app.config.setdefault('BCRYPT_POOL_SIZE', os.cpu_count() or 1)
+        self.queue_limit = app.config.setdefault('BCRYPT_QUEUE_LIMIT', max(self.pool_size, 1) * 4)
+        self.timeout = app.config.setdefault('BCRYPT_TIMEOUT', 10)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = None
+                if self.pool_size:
+                    self._executor = ProcessPoolExecutor(max_workers=self.pool_size, mp_context=multiprocessing.get_context('spawn'))
+                self._slots = threading.BoundedSemaphore(self.queue_limit)
+                self._pid = os.getpid()
+            return self._executor, self._slots
+
+    def _run(self, function, *args):
+        executor, slots = self._get_executor()
+        if not slots.acquire(blocking=False):
+            raise ServiceUnavailable('The server is busy checking passwords. Please try again later.')
+        started = time.perf_counter()
+        try:
+            if executor is None:
+                try:
+                    return function(*args)
+                finally:
+                    slots.release()
+            try:
+                future = executor.submit(function, *args)
+            except BaseException:
+                slots.release()
+                raise
+            # the slot is released when the job is done or cancelled, not when the request stops waiting for it,
+            # so a job still queued or running after the timeout keeps counting against the queue limit
+            future.add_done_callback(lambda future: slots.release())
+            try:
+                return future.result(timeout=self.timeout)
+            except TimeoutError:
+                future.cancel()
+                raise ServiceUnavailable('The server is busy checking passwords. Please try again later.')
+        finally:
+            if self.on_complete:
+                self.on_complete('bcrypt', time.perf_counter() - started)
+
+    def hash(self, password):
+        return self._run(hash_password, password, self.rounds)
+
+    def check(self, hashed, password):
+        return self._run(check_password, hashed, password)
+
+    # hash many passwords spread over all the worker processes, without the queue limit of the requests (used by the bulk import)
+    def hash_many(self, passwords):
+        executor, _ = self._get_executor()
+        if executor is None:
+            return [hash_password(password, self.rounds) for password in passwords]
+        chunksize = max(1, len(passwords) // (self.pool_size * 4))
+        return list(executor.map(hash_password, passwords, repeat(self.rounds), chunksize=chunksize))
+
+    # check if the hash was made with a work factor other than the configured one
+    def needs_rehash(self, hashed):
+        return hash_rounds(hashed) != self.rounds
@@ -0,0 +1,52 @@
+from flask import g
+from flask_jwt_extended import get_jwt, current_user
+from init import db, jwt
+from instrumentation import timed
+from models.customer import Customer
+from models.veterinarian import Veterinarian
+
+# the model used to load the user for each role contained in the token
+ROLE_MODELS = {'customer': Customer, 'veterinarian': Veterinarian}
+
+
+# load the user of the token with the model of its role, once per request
+@jwt.user_lookup_loader
+def user_lookup_callback(_jwt_header, jwt_data):
+    # the key of the user, used by the router to keep the users who have just written on the primary
+    g.jwt_identity = f"{jwt_data.get('role')}:{jwt_data['sub']}"
+    if 'identity' not in g:
+        model = ROLE_MODELS.get(jwt_data.get('role'))
+        with timed('auth'):
+            g.identity = db.session.get(model, int(jwt_data['sub'])) if model else None
+    return g.identity
+
+
+# set the key of the user who has just logged in, as the token of the request (if any) is not theirs
+# the router then keeps them on the primary for a while as after a write, since their account may not have reached the replica yet
+def logged_in(role, user_id):
+    g.jwt_identity = f'{role}:{user_id}'
+
+
+# get the role contained in the token
+def current_role():
+    return get_jwt().get('role')
+
+
+# get the key of the current user, e.g. customer:1
+def current_key():
+    return f'{current_role()}:{current_user.id}'
+
+
+# check if the person is a customer according to the token
+def is_customer():
+    return current_role() == 'customer'
+
+
+# check if the person is a veterinarian according to the token
+def is_veterinarian():
+    return current_role() == 'veterinarian'
+
+
+# check if the person is an administrator using the veterinarian loaded for the request
+def is_admin():
+    return is_veterinarian() and current_user.is_admin
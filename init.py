@@ -1,11 +1,10 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
-from flask_bcrypt import Bcrypt
+from hashing import PasswordHasher
+from routing import RoutingSession
 from flask_jwt_extended import JWTManager
-from flask_autodoc.autodoc import Autodoc
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 ma = Marshmallow()
-bcrypt = Bcrypt()
+hasher = PasswordHasher()
 jwt = JWTManager()
-auto = Autodoc()
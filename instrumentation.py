@@ -0,0 +1,145 @@
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from init import db, hasher
+
+# upper bounds of the histogram buckets for durations in seconds and for the number of SQL statements
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# the timed sections of a request reported in the Server-Timing header, besides db and total
+SECTIONS = ('auth', 'serialize', 'bcrypt')
+
+
+# check if the current request is being instrumented
+def instrumented():
+    return has_request_context() and 'timings' in g
+
+
+# add the duration to the timed section of the current request, if instrumented
+def record(section, seconds):
+    if instrumented():
+        g.timings[section] = g.timings.get(section, 0) + seconds
+
+
+# time the block as one section of the current request
+# a section nested in the same section (e.g. a nested schema) is only counted once
+@contextmanager
+def timed(section):
+    if not instrumented() or section in g.active_sections:
+        yield
+        return
+    g.active_sections.add(section)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        g.active_sections.discard(section)
+        record(section, time.perf_counter() - started)
+
+
+# A cumulative histogram in the Prometheus format.
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        label_text = ','.join(f'{key}="{value}"' for key, value in labels)
+        for bound, count in zip(self.buckets, self.counts):
+            yield f'{name}_bucket{{{label_text},le="{bound}"}} {count}'
+        yield f'{name}_bucket{{{label_text},le="+Inf"}} {self.count}'
+        yield f'{name}_sum{{{label_text}}} {self.sum}'
+        yield f'{name}_count{{{label_text}}} {self.count}'
+
+
+# Count the SQL statements and the database time of each request, time the authorization, serialization and bcrypt sections,
+# report them in the Server-Timing header and aggregate them into per-endpoint histograms served at /metrics (see controllers/metrics_controller.py).
+# Nothing is registered unless INSTRUMENTATION_ENABLED is set.
+class Instrumentation:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def init_app(self, app):
+        if not app.config.setdefault('INSTRUMENTATION_ENABLED', False):
+            return
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        with app.app_context():
+            engines = list(db.engines.values())
+        for engine in engines:
+            if not event.contains(engine, 'before_cursor_execute', before_cursor_execute):
+                event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+                event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+        hasher.on_complete = record
+
+    def start_request(self):
+        g.timings = {}
+        g.active_sections = set()
+        g.sql_statements = 0
+        g.request_started = time.perf_counter()
+
+    def finish_request(self, response):
+        if not instrumented():
+            return response
+        total = time.perf_counter() - g.request_started
+        db_time = g.timings.get('db', 0)
+        timings = [f'db;dur={db_time * 1000:.2f};desc="{g.sql_statements} statements"']
+        timings += [f'{section};dur={g.timings[section] * 1000:.2f}' for section in SECTIONS if section in g.timings]
+        timings.append(f'total;dur={total * 1000:.2f}')
+        response.headers['Server-Timing'] = ', '.join(timings)
+        endpoint = request.endpoint or 'unknown'
+        self.observe('http_request_duration_seconds', (('endpoint', endpoint), ('method', request.method)), total, DURATION_BUCKETS)
+        self.observe('db_duration_seconds', (('endpoint', endpoint),), db_time, DURATION_BUCKETS)
+        self.observe('db_statements', (('endpoint', endpoint),), g.sql_statements, STATEMENT_BUCKETS)
+        for section in SECTIONS:
+            if section in g.timings:
+                self.observe('section_duration_seconds', (('endpoint', endpoint), ('section', section)), g.timings[section], DURATION_BUCKETS)
+        return response
+
+    def observe(self, name, labels, value, buckets):
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[(name, labels)] = Histogram(buckets)
+            histogram.observe(value)
+
+    # return the histograms in the Prometheus text format
+    def metrics(self):
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f'# TYPE {name} histogram')
+                for (histogram_name, labels), histogram in sorted(self._histograms.items()):
+                    if histogram_name == name:
+                        lines.extend(histogram.lines(name, labels))
+        return '\n'.join(lines) + '\n', 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+# the start of the statement is kept on its execution context rather than on the connection,
+# so a statement which fails (and never reaches after_cursor_execute) leaves nothing behind
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'query_started', None)
+    if started is not None and instrumented():
+        g.sql_statements += 1
+        record('db', time.perf_counter() - started)
+
+
+instrumentation = Instrumentation()
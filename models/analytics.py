@@ -0,0 +1,28 @@
+from init import db
+from models.patient import SpeciesEnum
+
+# Define the summary tables of the analytics, which hold the number of appointments per week and are recomputed by `flask analytics refresh`.
+# A week is identified by the date of its Monday, i.e. date_trunc('week', date).
+# weekly_veterinarian_bookings has three columns (i.e. week, veterinarian_id and bookings), and week and veterinarian_id together are the primary key.
+# Its rows are deleted together with their veterinarian.
+class WeeklyVeterinarianBookings(db.Model):
+    __tablename__ = 'weekly_veterinarian_bookings'
+
+    week = db.Column(db.Date, primary_key=True)
+    veterinarian_id = db.Column(db.Integer, db.ForeignKey('veterinarians.id', ondelete='CASCADE'), primary_key=True)
+    bookings = db.Column(db.Integer, nullable=False)
+
+# weekly_species_bookings has three columns (i.e. week, species and bookings), and week and species together are the primary key.
+class WeeklySpeciesBookings(db.Model):
+    __tablename__ = 'weekly_species_bookings'
+
+    week = db.Column(db.Date, primary_key=True)
+    species = db.Column(db.Enum(SpeciesEnum), primary_key=True)
+    bookings = db.Column(db.Integer, nullable=False)
+
+# analytics_dirty_weeks has one column (i.e. week), which is the primary key.
+# A week is marked in the same transaction as the change of its appointments, and unmarked once its summary rows are recomputed.
+class AnalyticsDirtyWeek(db.Model):
+    __tablename__ = 'analytics_dirty_weeks'
+
+    week = db.Column(db.Date, primary_key=True)
@@ -1,19 +1,25 @@
 from sqlalchemy.orm import validates
 from init import db, ma
+import gb
 from sqlalchemy import UniqueConstraint
 from marshmallow import fields
 
 # Define an appointments table in the database with five columns (i.e. id, date, time, veterinarian_id and patient_id). Each colum has its own constraints.
-# In this table, id is the primary key, while veterinarian_id and patient_id are foreign keys.
+# In this table, id and date are the primary key, while veterinarian_id and patient_id are foreign keys.
 # This table has a relationship with the veterinarians table and the patients table, respectively.
 # As one veterinarian cannot have an appointment at the same time on the same date, the combination of date, time and veterinarian_id must be unique.
 # As one patient cannot have an appointment at the same time on the same date, the combination of date, time and patient_id must be unique as well.
+# The foreign key leads each unique constraint, so that their indexes also serve the queries for one veterinarian's or one patient's appointments by date and time.
+# The primary key of the table is the combination of id and date, as the table can be partitioned by date and the key of a partitioned table must include it.
+# id alone still identifies an appointment, and is the key of the records in the ORM.
 class Appointment(db.Model):
     __tablename__ = 'appointments'
 
-    id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.Date, nullable=False)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    date = db.Column(db.Date, primary_key=True)
     time = db.Column(db.Time, nullable=False)
+    # when the reminder of the appointment was sent, if it has been
+    reminded_at = db.Column(db.DateTime)
 
     veterinarian_id = db.Column(db.Integer, db.ForeignKey('veterinarians.id'), nullable=False)
     patient_id = db.Column(db.Integer, db.ForeignKey('patients.id'), nullable=False)
@@ -22,13 +28,16 @@ class Appointment(db.Model):
     patient = db.relationship('Patient', back_populates='appointments')
 
     __table_args__ = (
-        UniqueConstraint('date', 'time', 'veterinarian_id', name='appointment_veterinarian_uc'),
-        UniqueConstraint('date', 'time', 'patient_id', name='appointment_patient_uc')
+        UniqueConstraint('veterinarian_id', 'date', 'time', name='appointment_veterinarian_uc'),
+        UniqueConstraint('patient_id', 'date', 'time', name='appointment_patient_uc')
         )
+    __mapper_args__ = {'primary_key': [id]}
 
     @validates('time')
     def validate_time(self, key, value):
-        if value[-2:] not in ['00', '15', '30', '45']:
+        # the time is parsed in the same way as for locking the slot, i.e. hh:mm or hh:mm:ss
+        time = gb.time_value(value)
+        if time.minute % gb.SLOT_MINUTES or time.second:
             raise ValueError('Invalid time. Minutes must be 00, 15, 30 or 45.')
         return value
 
@@ -19,6 +19,13 @@ class Customer(db.Model):
 
     patients = db.relationship('Patient', back_populates='customer', cascade='all, delete')
 
+    # the trigram indexes serve the prefix and fuzzy matching of the owners' names and emails in the patient search
+    __table_args__ = (
+        db.Index('customer_first_name_trgm_ix', 'first_name', postgresql_using='gin', postgresql_ops={'first_name': 'gin_trgm_ops'}),
+        db.Index('customer_last_name_trgm_ix', 'last_name', postgresql_using='gin', postgresql_ops={'last_name': 'gin_trgm_ops'}),
+        db.Index('customer_email_trgm_ix', 'email', postgresql_using='gin', postgresql_ops={'email': 'gin_trgm_ops'})
+        )
+
     @validates('last_name', 'first_name')
     def validate_last_name(self, key, value):
         if len(value) == 0:
@@ -45,4 +52,7 @@ class CustomerSchema(ma.Schema):
     class Meta:
         fields = ('id', 'first_name', 'last_name', 'email', 'contact_number', 'patients')
 
-    
\ No newline at end of file
+
+
+# the trigram indexes of the customers and patients tables need the pg_trgm extension, which is created before the tables
+db.event.listen(db.metadata, 'before_create', db.DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
@@ -37,7 +37,11 @@ class Patient(db.Model):
     customer = db.relationship('Customer', back_populates='patients')
     appointments = db.relationship('Appointment', back_populates='patient', cascade='all, delete')
 
-    __table_args__ = (UniqueConstraint('customer_id', 'name', name='customer_patient_uc'),)
+    # the trigram index serves both the prefix (ILIKE 'max%') and the fuzzy (name % 'max') matching of the patient search
+    __table_args__ = (
+        UniqueConstraint('customer_id', 'name', name='customer_patient_uc'),
+        db.Index('patient_name_trgm_ix', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+        )
 
     @validates('name')
     def validate_name(self, key, value):
@@ -74,4 +78,5 @@ class PatientSchema(ma.Schema):
     species = EnumField(SpeciesEnum)
 
     class Meta:
-        fields = ('id', 'name', 'age', 'weight', 'sex', 'species', 'customer_id', 'customer', 'appointments')
\ No newline at end of file
+        fields = ('id', 'name', 'age', 'weight', 'sex', 'species', 'customer_id', 'customer', 'appointments')
+
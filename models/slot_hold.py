@@ -0,0 +1,25 @@
+from init import db, ma
+
+# Define a slot_holds table in the database with seven columns (i.e. id, date, time, veterinarian_id, patient_id, holder and expires_at) which is used to reserve an appointment slot for a short time before it is booked.
+# In this table, id is the primary key, while veterinarian_id and patient_id are foreign keys. The holds are deleted together with their veterinarian or patient.
+# holder identifies the user who made the hold (e.g. customer:1), and only that user can confirm or release it.
+# A hold is only valid until expires_at. Its slot is checked under an advisory lock rather than a unique constraint, as an expired hold must not block the slot.
+class SlotHold(db.Model):
+    __tablename__ = 'slot_holds'
+
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, nullable=False)
+    time = db.Column(db.Time, nullable=False)
+    veterinarian_id = db.Column(db.Integer, db.ForeignKey('veterinarians.id', ondelete='CASCADE'), nullable=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patients.id', ondelete='CASCADE'), nullable=False)
+    holder = db.Column(db.String(50), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    __table_args__ = (
+        db.Index('slot_hold_veterinarian_ix', 'veterinarian_id', 'date', 'time'),
+        db.Index('slot_hold_patient_ix', 'patient_id', 'date', 'time')
+        )
+
+class SlotHoldSchema(ma.Schema):
+    class Meta:
+        fields = ('id', 'date', 'time', 'veterinarian_id', 'patient_id', 'expires_at')
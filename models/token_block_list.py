@@ -1,10 +1,12 @@
 from init import db
 
-# Define a tokenblocklist table in the database with three columns (i.e. id, jti and created_at) which is used to store the revoked tokens. Each colum has its own constraints.
+# Define a tokenblocklist table in the database with four columns (i.e. id, jti, created_at and expires_at) which is used to store the revoked tokens. Each colum has its own constraints.
 # In this table, id is the primary key.
+# As one token can only be revoked once, jti in the table must be unique. expires_at is copied from the token so that the expired records can be pruned.
 class TokenBlocklist(db.Model):
     __tablename__ = 'blocked_tokens'
-    
+
     id = db.Column(db.Integer, primary_key=True)
-    jti = db.Column(db.String(36), nullable=False, index=True)
-    created_at = db.Column(db.DateTime, nullable=False)
\ No newline at end of file
+    jti = db.Column(db.String(36), nullable=False, unique=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
\ No newline at end of file
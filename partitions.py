@@ -0,0 +1,103 @@
+import gzip
+import os
+import re
+from datetime import date
+from sqlalchemy import text
+from init import db
+from models.appointment import Appointment
+
+# The appointments table can be partitioned by the month of date (see `flask db create --partitioned`).
+# Each month is kept in its own partition named appointments_yyyy_mm, and the dates without one go to the default partition appointments_default.
+# The unique constraints of the table include date, so PostgreSQL enforces them within each partition, and the queries filtered by date only scan the partitions of their months.
+TABLE = Appointment.__tablename__
+DEFAULT_PARTITION = f'{TABLE}_default'
+PARTITION_NAME = re.compile(rf'^{TABLE}_(\d{{4}})_(\d{{2}})$')
+
+
+# get the first day of the month of the date, moved by the given number of months
+def month_start(value, months=0):
+    index = value.year * 12 + value.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+# get the name of the partition of the month
+def partition_name(month):
+    return f'{TABLE}_{month.year:04d}_{month.month:02d}'
+
+
+# get the month of the partition with the name, or None if it is not a monthly partition
+def partition_month(name):
+    match = PARTITION_NAME.match(name)
+    return date(int(match[1]), int(match[2]), 1) if match else None
+
+
+# check if the appointments table in the database is partitioned
+def is_partitioned():
+    return db.session.scalar(text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:table)"), {'table': TABLE}) or False
+
+
+# create the appointments table partitioned by date with its default partition, and all other tables as usual
+# the partitioning is only set for this statement, so the model still creates a plain table with `flask db create`
+def create_partitioned_tables():
+    table = Appointment.__table__
+    db.metadata.create_all(db.engine, tables=[other for other in db.metadata.sorted_tables if other is not table])
+    options = table.dialect_options['postgresql']
+    options['partition_by'] = 'RANGE (date)'
+    try:
+        table.create(db.engine)
+    finally:
+        options['partition_by'] = None
+    db.session.execute(text(f'CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT'))
+    db.session.commit()
+
+
+# get the monthly partitions attached to the appointments table by month
+def attached_partitions():
+    stmt = text('SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid WHERE pg_inherits.inhparent = to_regclass(:table)')
+    names = db.session.scalars(stmt, {'table': TABLE})
+    return {partition_month(name): name for name in names if partition_month(name)}
+
+
+# get the monthly partitions which have been detached from the appointments table but not archived yet, by month
+def detached_partitions():
+    names = db.session.scalars(text("SELECT tablename FROM pg_tables WHERE schemaname = current_schema() AND tablename LIKE :pattern"), {'pattern': f'{TABLE}\\_%'})
+    attached = attached_partitions()
+    return {partition_month(name): name for name in names if partition_month(name) and partition_month(name) not in attached}
+
+
+# create the partition of the month, and return whether it was created
+# the partition is built as a table of its own and then attached, so the rows of the month which were stored in the default partition
+# (e.g. booked before the partition existed) are moved into it rather than blocking it
+def create_partition(month):
+    name = partition_name(month)
+    if db.session.scalar(text('SELECT to_regclass(:name)'), {'name': name}):
+        return False
+    bounds = {'start': month, 'end': month_start(month, 1)}
+    db.session.execute(text(f'CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'))
+    db.session.execute(text(f'INSERT INTO {name} SELECT * FROM {DEFAULT_PARTITION} WHERE date >= :start AND date < :end'), bounds)
+    db.session.execute(text(f'DELETE FROM {DEFAULT_PARTITION} WHERE date >= :start AND date < :end'), bounds)
+    db.session.execute(text(f"ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM ('{bounds['start']}') TO ('{bounds['end']}')"))
+    db.session.commit()
+    return True
+
+
+# detach the partition from the appointments table, so its rows are kept in a table of its own but no longer queried
+def detach_partition(name):
+    db.session.execute(text(f'ALTER TABLE {TABLE} DETACH PARTITION {name}'))
+    db.session.commit()
+
+
+# write the rows of the partition to a gzip compressed CSV file in the directory, then drop the partition, and return the path of the file
+# the partition is detached first if it is still attached, and it is only dropped once the file is complete
+def archive_partition(name, directory):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{name}.csv.gz')
+    if name in attached_partitions().values():
+        db.session.execute(text(f'ALTER TABLE {TABLE} DETACH PARTITION {name}'))
+    cursor = db.session.connection().connection.cursor()
+    with gzip.open(path + '.part', 'wb') as f:
+        cursor.copy_expert(f'COPY {name} TO STDOUT WITH (FORMAT csv, HEADER)', f)
+    os.replace(path + '.part', path)
+    db.session.execute(text(f'DROP TABLE {name}'))
+    db.session.commit()
+    return path
@@ -0,0 +1,33 @@
+from contextlib import contextmanager
+from sqlalchemy import event
+from init import db
+
+
+# collect the SQL statements executed by any engine of the app while the block runs
+# e.g. with count_queries(app) as statements: client.get('/customers/')
+@contextmanager
+def count_queries(app):
+    with app.app_context():
+        engines = list(db.engines.values())
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        for engine in engines:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+# fail if the block executes more SQL statements than the limit, so that N+1 queries introduced in an endpoint are caught
+# e.g. with assert_max_queries(app, 3): client.get('/customers/', headers=headers)
+@contextmanager
+def assert_max_queries(app, limit):
+    with count_queries(app) as statements:
+        yield statements
+    if len(statements) > limit:
+        raise AssertionError(f'{len(statements)} SQL statements executed, expected at most {limit}:\n' + '\n'.join(statements))
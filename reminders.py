@@ -0,0 +1,116 @@
+import asyncio
+import json
+import smtplib
+from email.message import EmailMessage
+from datetime import datetime
+from init import db
+from models.appointment import Appointment
+from models.patient import Patient
+from models.customer import Customer
+from models.veterinarian import Veterinarian
+
+
+# Append each reminder to a file as one line of JSON, e.g. for tests or for another system to pick up.
+# The line is written without awaiting, so the concurrent sends never interleave.
+class FileSink:
+    def __init__(self, path):
+        self.path = path
+
+    async def send(self, reminder):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(reminder) + '\n')
+
+
+# Send each reminder as an email through an SMTP server, e.g. a local stand-in such as `python -m aiosmtpd -n` on port 1025.
+# smtplib blocks, so each email is sent in a thread of the default executor.
+class SMTPSink:
+    def __init__(self, host, port, sender):
+        self.host = host
+        self.port = port
+        self.sender = sender
+
+    def _send(self, reminder):
+        message = EmailMessage()
+        message['From'] = self.sender
+        message['To'] = reminder['email']
+        message['Subject'] = reminder['subject']
+        message.set_content(reminder['body'])
+        with smtplib.SMTP(self.host, self.port, timeout=30) as smtp:
+            smtp.send_message(message)
+
+    async def send(self, reminder):
+        await asyncio.to_thread(self._send, reminder)
+
+
+# build the sink configured in the app, or the given one
+def make_sink(config, name=None):
+    name = name or config['REMINDER_SINK']
+    if name == 'file':
+        return FileSink(config['REMINDER_FILE'])
+    elif name == 'smtp':
+        return SMTPSink(config['REMINDER_SMTP_HOST'], config['REMINDER_SMTP_PORT'], config['REMINDER_SENDER'])
+    raise ValueError(f'Invalid reminder sink {name} - It must be file or smtp')
+
+
+# the statement selecting the appointments on the date which have not been reminded yet, with the contact details of the customers
+def reminders_stmt(date):
+    return db.select(
+        Appointment.id, Appointment.date, Appointment.time, Patient.name.label('patient_name'),
+        Customer.first_name, Customer.email, Customer.contact_number,
+        Veterinarian.first_name.label('veterinarian_first_name'), Veterinarian.last_name.label('veterinarian_last_name')
+    ).join(Patient, Patient.id==Appointment.patient_id).join(Customer, Customer.id==Patient.customer_id).join(
+        Veterinarian, Veterinarian.id==Appointment.veterinarian_id
+    ).filter(Appointment.date==date, Appointment.reminded_at.is_(None)).order_by(Appointment.id)
+
+
+# build the reminder of one appointment
+def make_reminder(row):
+    veterinarian = f'{row.veterinarian_first_name} {row.veterinarian_last_name}'
+    return {
+        'appointment_id': row.id,
+        'email': row.email,
+        'contact_number': row.contact_number,
+        'subject': f'Reminder: {row.patient_name} has an appointment on {row.date.isoformat()}',
+        'body': f"Dear {row.first_name},\n\nThis is a reminder that {row.patient_name} has an appointment with {veterinarian} on {row.date.isoformat()} at {row.time.strftime('%H:%M')}.\n"
+    }
+
+
+# send one reminder, retrying with exponential backoff, and return whether it was sent
+async def send_reminder(sink, reminder, slots, retries, backoff):
+    async with slots:
+        for attempt in range(retries + 1):
+            try:
+                await sink.send(reminder)
+                return True
+            except Exception as err:
+                if attempt == retries:
+                    print(f"Reminder for appointment {reminder['appointment_id']} failed: {err}")
+                    return False
+                await asyncio.sleep(backoff * 2 ** attempt)
+
+
+# send the reminders concurrently, at most concurrency at a time, and return the ids of the appointments reminded
+async def send_reminders(sink, reminders, concurrency, retries, backoff):
+    slots = asyncio.Semaphore(concurrency)
+    sent = await asyncio.gather(*[send_reminder(sink, reminder, slots, retries, backoff) for reminder in reminders])
+    return [reminder['appointment_id'] for reminder, ok in zip(reminders, sent) if ok]
+
+
+# remind the customers of the appointments on the date which have not been reminded yet
+# the appointments are streamed from one query in batches, and the reminded ones are marked batch by batch,
+# so a rerun only sends the reminders which have not been sent (or failed) before
+def remind(date, sink, concurrency, retries, backoff, batch_size):
+    sent = 0
+    failed = 0
+    with db.engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(reminders_stmt(date))
+        for rows in result.partitions():
+            reminders = [make_reminder(row) for row in rows]
+            reminded = asyncio.run(send_reminders(sink, reminders, concurrency, retries, backoff))
+            if reminded:
+                stmt = db.update(Appointment).where(Appointment.id.in_(reminded)).values(reminded_at=datetime.now()).execution_options(synchronize_session=False)
+                db.session.execute(stmt)
+                db.session.commit()
+            sent += len(reminded)
+            failed += len(reminders) - len(reminded)
+    return sent, failed
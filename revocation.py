@@ -0,0 +1,148 @@
+import threading
+from datetime import datetime, timedelta
+from init import db, jwt
+from cache import LRUCache, BloomFilter
+from instrumentation import timed
+from routing import primary
+from models.token_block_list import TokenBlocklist
+
+# tokens revoked within this period before the last sync are loaded again, so that rows committed late by other processes are not missed
+SYNC_OVERLAP = timedelta(seconds=60)
+
+missing = object()
+
+
+# Keep the revoked tokens in memory so that most authenticated requests are answered without querying the blocked_tokens table.
+# The bloom filter holds every unexpired revoked jti and answers the negative lookups, i.e. the tokens which have never been revoked.
+# The LRU cache holds the recent positive lookups, and the database is only queried when a jti is neither ruled out nor cached.
+# As tokens can be revoked by other processes, the bloom filter is synced with the table every JWT_BLOCKLIST_SYNC_SECONDS.
+class RevocationCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.capacity = 100000
+        self.sync_seconds = 5
+        self.recent = LRUCache()
+        self._reset()
+
+    def init_app(self, app):
+        self.capacity = app.config.setdefault('JWT_BLOCKLIST_CAPACITY', 100000)
+        self.sync_seconds = app.config.setdefault('JWT_BLOCKLIST_SYNC_SECONDS', 5)
+        self.recent = LRUCache(app.config.setdefault('JWT_BLOCKLIST_CACHE_SIZE', 10000))
+        self._reset()
+
+    def _reset(self):
+        self._bloom = BloomFilter(self.capacity)
+        self._synced_at = None
+        self._next_sync = 0
+        # the tokens revoked by this process while the bloom filter is being rebuilt, or None if it is not
+        self._revoked_meanwhile = None
+
+    # get the jtis of the unexpired tokens revoked since the given time (less the overlap), or of all of them
+    def _load(self, since=None):
+        stmt = db.select(TokenBlocklist.jti).filter(TokenBlocklist.expires_at > datetime.now())
+        if since:
+            stmt = stmt.filter(TokenBlocklist.created_at >= since - SYNC_OVERLAP)
+        return db.session.scalars(stmt).all()
+
+    # add the jtis to the bloom filter, skipping those in it already (e.g. loaded again by the overlap) so that its count is not inflated
+    def _merge(self, jtis, synced_at):
+        for jti in jtis:
+            if jti not in self._bloom:
+                self._bloom.add(jti)
+            self.recent.set(jti, True)
+        if self._synced_at is None or synced_at > self._synced_at:
+            self._synced_at = synced_at
+
+    # load the tokens revoked since the last sync (or all unexpired ones for the first sync) into the bloom filter
+    # the table is queried outside the lock, so the other requests keep answering from the bloom filter meanwhile,
+    # except for the first sync which they wait for, as the bloom filter is empty until then
+    def _sync(self, if_due=False):
+        with self._lock:
+            now = datetime.now()
+            if if_due and now.timestamp() < self._next_sync:
+                return
+            # the next sync is only scheduled once the first load has succeeded, so that a failed first sync is retried
+            # by the next request rather than leaving the bloom filter empty (i.e. accepting every token) until then
+            if self._synced_at is None:
+                self._merge(self._load(), now)
+                self._next_sync = now.timestamp() + self.sync_seconds
+                return
+            self._next_sync = now.timestamp() + self.sync_seconds
+            synced_at = self._synced_at
+        try:
+            jtis = self._load(synced_at)
+        except Exception:
+            with self._lock:
+                self._next_sync = 0
+            raise
+        with self._lock:
+            self._merge(jtis, now)
+            rebuild = self._bloom.count > self.capacity and self._revoked_meanwhile is None
+            if rebuild:
+                self._revoked_meanwhile = []
+        # rebuild the bloom filter from the unexpired tokens only once it is over its capacity
+        if rebuild:
+            self._rebuild()
+
+    # replace the bloom filter by a new one holding the unexpired tokens, including those revoked by this process while it is loaded
+    def _rebuild(self):
+        bloom = BloomFilter(self.capacity)
+        try:
+            for jti in self._load():
+                bloom.add(jti)
+        except Exception:
+            with self._lock:
+                self._revoked_meanwhile = None
+            raise
+        with self._lock:
+            for jti in self._revoked_meanwhile:
+                bloom.add(jti)
+            self._bloom = bloom
+            self._revoked_meanwhile = None
+
+    # load the revoked tokens now rather than on the next authenticated request, e.g. before the statements of a request are counted
+    def sync(self):
+        with primary():
+            self._sync()
+
+    # the blocked tokens are read from the primary, so a token revoked by another process is not missed because of the replication lag
+    def is_revoked(self, jti):
+        with primary():
+            return self._is_revoked(jti)
+
+    def _is_revoked(self, jti):
+        if datetime.now().timestamp() >= self._next_sync:
+            self._sync(if_due=True)
+        with self._lock:
+            if jti not in self._bloom:
+                return False
+        revoked = self.recent.get(jti, missing)
+        if revoked is missing:
+            stmt = db.select(TokenBlocklist.id).filter_by(jti=jti)
+            revoked = db.session.scalar(stmt) is not None
+            self.recent.set(jti, revoked)
+        return revoked
+
+    # add the token to the blocked_tokens table and to the cache of this process
+    def revoke(self, jti, expires_at):
+        db.session.add(TokenBlocklist(jti=jti, created_at=datetime.now(), expires_at=expires_at))
+        db.session.commit()
+        with self._lock:
+            self._bloom.add(jti)
+            if self._revoked_meanwhile is not None:
+                self._revoked_meanwhile.append(jti)
+        self.recent.set(jti, True)
+
+
+revocation = RevocationCache()
+
+
+@jwt.token_in_blocklist_loader
+def check_if_token_revoked(jwt_header, jwt_payload):
+    with timed('auth'):
+        return revocation.is_revoked(jwt_payload['jti'])
+
+
+@jwt.revoked_token_loader
+def revoked_token(jwt_header, jwt_payload):
+    return {'error': "You haven't logged into the app yet."}, 401
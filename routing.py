@@ -0,0 +1,72 @@
+import functools
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from flask_sqlalchemy.session import Session
+from cache import LRUCache
+
+# the request methods which only read, and can be served by the read replica
+READ_METHODS = ('GET', 'HEAD')
+
+
+# Route the queries of the read requests to the read replica, if the replica bind is configured.
+# A user who has just written (e.g. booked or updated an appointment) reads from the primary for REPLICA_STICKY_SECONDS,
+# so they see their own writes despite the replication lag.
+# The window is kept in each process, and is meant to cover the lag rather than the lifetime of a token.
+class ReplicaRouter:
+    def __init__(self):
+        self.writers = LRUCache(max_size=10000, ttl=5)
+
+    def init_app(self, app):
+        sticky_seconds = app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+        self.writers = LRUCache(max_size=app.config.setdefault('REPLICA_STICKY_CACHE_SIZE', 10000), ttl=sticky_seconds)
+        app.after_request(self.remember_writer)
+
+    # keep the user of a successful write request on the primary for a while
+    def remember_writer(self, response):
+        writer = g.get('jwt_identity')
+        if request.method not in READ_METHODS and response.status_code < 400 and writer:
+            self.writers.set(writer, True)
+        return response
+
+    def reads_from_replica(self):
+        if not has_request_context() or request.method not in READ_METHODS or g.get('use_primary'):
+            return False
+        writer = g.get('jwt_identity')
+        return not (writer and self.writers.get(writer))
+
+
+router = ReplicaRouter()
+
+
+# The session of the app, which sends the queries to the replica when the router says so, and everything else to the primary.
+# The flushes always go to the primary.
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and router.reads_from_replica():
+            engine = self._db.engines.get('replica')
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+# send the queries of the block to the primary, e.g. for data which must not lag behind
+@contextmanager
+def primary():
+    if not has_request_context():
+        yield
+        return
+    previous = g.get('use_primary', False)
+    g.use_primary = True
+    try:
+        yield
+    finally:
+        g.use_primary = previous
+
+
+# send all queries of the view to the primary
+def use_primary(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with primary():
+            return view(*args, **kwargs)
+    return wrapper
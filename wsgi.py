@@ -0,0 +1,7 @@
+from app import create_app, warm_up
+
+# The entry point of the app in production, e.g. `gunicorn -c gunicorn.conf.py wsgi:app`.
+# With preload_app, the app is created and warmed up once in the master process, and the workers forked from it
+# share the imported code, the configured mappers and the built schemas.
+app = create_app()
+warm_up(app)